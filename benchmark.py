@@ -0,0 +1,303 @@
+########################################################################
+# YouTube BoundingBox Benchmark
+########################################################################
+#
+# This script measures the throughput of the parsing, cutting, frame
+# decoding and VOC conversion stages without touching the network. It
+# generates a synthetic data set shaped like YouTube BoundingBoxes: an
+# annotation csv file with the requested number of videos and classes,
+# and source videos rendered locally with ffmpeg's test sources. The
+# source videos are linked into place by youtube_bb.local_sources in place
+# of youtube-dl. Every stage is timed at each scale and worker count, and
+# the results are written as JSON so that runs on different commits can
+# be compared.
+#
+########################################################################
+#
+# The work directory holds the following:
+#
+# work_dir/yt_bb_detection_train.csv    (Synthetic annotations)
+# work_dir/sources/source_idx.mp4       (Synthetic source videos)
+# work_dir/sources/by_id/yt_id.mp4      (Links to them, one per video)
+# work_dir/videos/d_set/class_id/clip_name.mp4
+# work_dir/voc/youtubebbdevkit2017/...
+#
+########################################################################
+
+from __future__ import unicode_literals
+import youtube_bb
+import voc_convert
+import argparse
+import platform
+import tempfile
+import random
+import shutil
+import json
+import time
+import csv
+import os
+import sys
+from subprocess import check_output
+
+# The synthetic data set mimics the detection training set
+d_set = 'yt_bb_detection_train'
+
+# Write a synthetic annotation csv file of `num_videos` videos. Each video
+# has `clips_per_video` clips (objects) of classes drawn from the first
+# `num_classes` classes, annotated once a second for `frames_per_clip`
+# seconds.
+def write_csv(path,
+              num_videos,
+              num_classes,
+              clips_per_video,
+              frames_per_clip,
+              present_ratio=0.8,
+              seed=0):
+  rng  = random.Random(seed)
+  rows = []
+  for vid_idx in range(num_videos):
+    yt_id = 'synth{:07d}'.format(vid_idx)
+    for obj_id in range(clips_per_video):
+      class_ = youtube_bb.class_list[rng.randrange(num_classes)]
+      for second in range(frames_per_clip):
+        present = rng.random() < present_ratio
+        if present:
+          xmin = rng.uniform(0.0,0.5)
+          ymin = rng.uniform(0.0,0.5)
+          box  = [xmin, xmin+rng.uniform(0.1,0.5),
+                  ymin, ymin+rng.uniform(0.1,0.5)]
+          box  = ['{:.6f}'.format(x) for x in box]
+        else:
+          box  = ['-1.0']*4
+        rows.append([yt_id, str(second*1000), str(class_[0]), class_[1],
+                     str(obj_id), 'present' if present else 'absent'] + box)
+
+  # The published annotation files are not sorted
+  rng.shuffle(rows)
+  with open(path,'w') as f:
+    csv.writer(f).writerows(rows)
+  return len(rows)
+
+# Render `num_sources` synthetic source videos of `duration` seconds with
+# ffmpeg's test sources
+def write_sources(source_dir,num_sources,duration,size):
+  os.makedirs(source_dir, exist_ok=True)
+  sources = []
+  for source_idx in range(num_sources):
+    source_path = source_dir+'/source_'+str(source_idx)+'.mp4'
+    if not os.path.exists(source_path):
+      # Vary the pattern so that the sources don't encode identically
+      pattern = ['testsrc','testsrc2','smptebars','rgbtestsrc'][ \
+        source_idx % 4]
+      youtube_bb.run_ffmpeg(['ffmpeg', '-y',
+        '-f', 'lavfi',
+        '-i', pattern+'=size='+size+':rate=30:duration='+str(duration),
+        '-c:v', 'libx264',
+        '-pix_fmt', 'yuv420p',
+        source_path])
+    sources.append(source_path)
+  return sources
+
+# Link every video of `vids` to one of the synthetic source videos, named
+# `yt_id.mp4` in `source_dir` as youtube_bb.local_sources expects
+def link_sources(source_dir,sources,vids):
+  os.makedirs(source_dir, exist_ok=True)
+  for vid in vids:
+    vid_idx     = int(vid.yt_id[len('synth'):])
+    source_path = source_dir+'/'+vid.yt_id+'.mp4'
+    if not os.path.exists(source_path):
+      youtube_bb.link_or_copy(sources[vid_idx % len(sources)],source_path)
+
+# Run `func` and return its result along with the elapsed wall time
+def timed(func,*args,**kwargs):
+  start  = time.time()
+  result = func(*args,**kwargs)
+  return result, time.time()-start
+
+def result(stage,scale,workers,seconds,items,unit):
+  return {'stage':        stage,
+          'scale':        scale,
+          'workers':      workers,
+          'seconds':      round(seconds,4),
+          'items':        items,
+          'unit':         unit,
+          'items_per_sec': round(items/seconds,2) if seconds > 0 else None}
+
+def print_result(res):
+  print('{stage:>8} scale={scale:<6} workers={workers:<3} '
+        '{seconds:9.3f}s {items:>8} {unit} ({items_per_sec} / s)'.format( \
+        **res))
+
+def bench_parse(scale,work_dir):
+  # Cold: build the columnar store from the csv file
+  shutil.rmtree(work_dir+'/'+d_set+'.cols', ignore_errors=True)
+  (annotations,clips,vids,clip_idx), cold = \
+    timed(youtube_bb.parse_annotations,d_set,work_dir+'/videos',work_dir)
+  # Warm: load the cached store
+  (annotations,clips,vids,clip_idx), warm = \
+    timed(youtube_bb.parse_annotations,d_set,work_dir+'/videos',work_dir)
+  return vids, [result('parse',scale,1,cold,len(annotations),'rows'),
+                result('parse_warm',scale,1,warm,len(annotations),'rows')]
+
+def bench_cut(scale,workers,vids,fetch,cut_mode,work_dir):
+  shutil.rmtree(work_dir+'/videos', ignore_errors=True)
+  os.makedirs(work_dir+'/videos/'+d_set)
+  pipeline = youtube_bb.dl_pipeline(workers,
+                                    workers,
+                                    cut_mode=cut_mode,
+                                    total=len(vids),
+                                    fetch=fetch)
+  def run():
+    for vid in vids:
+      pipeline.submit(vid)
+    pipeline.close()
+  _, seconds = timed(run)
+  sys.stderr.write('\n')
+  num_clips = sum(len(vid.clips) for vid in vids)
+  return result('cut',scale,workers,seconds,num_clips,'clips')
+
+def bench_voc(scale,workers,work_dir):
+  dest_dir = work_dir+'/voc/'
+  shutil.rmtree(dest_dir, ignore_errors=True)
+  for sub_dir in ['ImageSets/Main','JPEGImages','Annotations']:
+    os.makedirs(dest_dir+'youtubebbdevkit2017/youtubebb2017/'+sub_dir)
+  # Start from a cold probe cache so that probing is included
+  probes_path = work_dir+'/videos/'+d_set+'/probes.json'
+  if os.path.exists(probes_path):
+    os.remove(probes_path)
+  xml_annots, decode_secs = timed(voc_convert.decode_frames,
+                                  d_set,work_dir+'/videos/',dest_dir,workers,
+                                  0,0,False,annot_dir=work_dir)
+  _, txt_secs = timed(voc_convert.write_txt_files,dest_dir,xml_annots,[])
+  return [result('decode',scale,workers,decode_secs,len(xml_annots),'frames'),
+          result('imagesets',scale,workers,txt_secs,len(xml_annots),
+                 'frames')]
+
+def version(args):
+  try:
+    return check_output(args,stderr=open(os.devnull,'w')).decode( \
+      'utf-8','replace').splitlines()[0].strip()
+  except Exception:
+    return None
+
+def benchmark(work_dir,
+              scales,
+              workers,
+              num_classes=23,
+              clips_per_video=2,
+              frames_per_clip=10,
+              num_sources=4,
+              size='640x360',
+              cut_mode='multi',
+              stages=['parse','cut','decode']):
+  """Run the benchmark in `work_dir` at each number of videos in `scales`
+  and each number of workers in `workers`. Returns the JSON results.
+  """
+
+  repo_dir = os.path.dirname(os.path.abspath(__file__))
+  report   = {'commit':   version(['git','-C',repo_dir,'rev-parse','HEAD']),
+              'python':   platform.python_version(),
+              'platform': platform.platform(),
+              'cpus':     os.cpu_count(),
+              'ffmpeg':   version(['ffmpeg','-version']),
+              'config':   {'scales':          scales,
+                           'workers':         workers,
+                           'num_classes':     num_classes,
+                           'clips_per_video': clips_per_video,
+                           'frames_per_clip': frames_per_clip,
+                           'num_sources':     num_sources,
+                           'size':            size,
+                           'cut_mode':        cut_mode,
+                           'stages':          stages},
+              'results':  []}
+
+  # Annotations are read from and cached in the work directory
+  work_dir = os.path.abspath(work_dir)
+  os.makedirs(work_dir, exist_ok=True)
+
+  # The last annotation of a clip is at frames_per_clip-1 seconds
+  sources = write_sources(work_dir+'/sources',num_sources,frames_per_clip+1,
+                          size)
+  fetch   = youtube_bb.local_sources(work_dir+'/sources/by_id')
+
+  def add(res):
+    print_result(res)
+    report['results'].append(res)
+
+  for scale in scales:
+    write_csv(work_dir+'/'+d_set+'.csv',scale,num_classes,clips_per_video,
+              frames_per_clip)
+    vids, parse_results = bench_parse(scale,work_dir)
+    link_sources(work_dir+'/sources/by_id',sources,vids)
+    if 'parse' in stages:
+      for res in parse_results:
+        add(res)
+    for num_workers in workers:
+      if ('cut' in stages) or ('decode' in stages):
+        res = bench_cut(scale,num_workers,vids,fetch,cut_mode,work_dir)
+        if 'cut' in stages:
+          add(res)
+      if 'decode' in stages:
+        for res in bench_voc(scale,num_workers,work_dir):
+          add(res)
+
+  return report
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser( \
+    description='Benchmark parsing, cutting, decoding and VOC conversion on '
+                'a synthetic data set, without downloading anything.')
+  parser.add_argument('--scales', default='10,100',
+    help='Comma separated numbers of videos in the synthetic data set '
+         '(default: %(default)s)')
+  parser.add_argument('--workers', default='1,4',
+    help='Comma separated numbers of worker threads (default: %(default)s)')
+  parser.add_argument('--classes', type=int, default=23,
+    help='Number of classes to draw the clips from (default: %(default)s)')
+  parser.add_argument('--clips-per-video', type=int, default=2,
+    help='Number of clips in every video (default: %(default)s)')
+  parser.add_argument('--frames-per-clip', type=int, default=10,
+    help='Number of annotated frames in every clip (default: %(default)s)')
+  parser.add_argument('--sources', type=int, default=4,
+    help='Number of distinct source videos to render (default: %(default)s)')
+  parser.add_argument('--size', default='640x360',
+    help='Size of the source videos (default: %(default)s)')
+  parser.add_argument('--cut-mode', choices=youtube_bb.cut_modes,
+    default='multi',
+    help='How clips are cut from each video (default: %(default)s)')
+  parser.add_argument('--stages', default='parse,cut,decode',
+    help='Comma separated stages to time (default: %(default)s)')
+  parser.add_argument('--work-dir', default=None,
+    help='Directory for the synthetic data set (default: a temporary '
+         'directory which is removed afterwards)')
+  parser.add_argument('--output', default=None,
+    help='File to write the JSON results to (default: standard output)')
+  args = parser.parse_args()
+
+  assert(1 <= args.classes <= len(youtube_bb.class_list)), \
+    "Number of classes must be between 1 and "+str(len(youtube_bb.class_list))
+
+  output   = os.path.abspath(args.output) if args.output else None
+  work_dir = args.work_dir or tempfile.mkdtemp(prefix='yt_bb_bench_')
+  try:
+    report = benchmark(work_dir,
+                       [int(x) for x in args.scales.split(',')],
+                       [int(x) for x in args.workers.split(',')],
+                       args.classes,
+                       args.clips_per_video,
+                       args.frames_per_clip,
+                       args.sources,
+                       args.size,
+                       args.cut_mode,
+                       args.stages.split(','))
+  finally:
+    if args.work_dir is None:
+      shutil.rmtree(work_dir, ignore_errors=True)
+
+  if output is None:
+    json.dump(report, sys.stdout, indent=2)
+    print('')
+  else:
+    with open(output,'w') as f:
+      json.dump(report, f, indent=2)
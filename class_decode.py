@@ -14,65 +14,86 @@
 from __future__ import unicode_literals
 import youtube_bb
 import sys
-import random
+import argparse
+import json
+import shutil
+import tempfile
 import os
-import csv
-import subprocess
-from xml.etree.ElementTree import Element, SubElement, Comment, tostring
-from xml.dom import minidom
-from PIL import Image
 from concurrent import futures
-from subprocess import check_call
-
-## Decode all the clips in a given vid
-def decode_frame(clips,
-                 annot,
-                 max_ratio,
-                 d_set,
-                 src_dir,
-                 dest_dir):
-  yt_id    = annot[0]
-  class_id = annot[2]
-  obj_id   = '0' # Set to zero since classification task has no object
-  annot_clip_path = src_dir+'/'+d_set+'/'+class_id+'/'
-  annot_clip_name = yt_id+'+'+class_id+'+'+obj_id+'.mp4'
-  clip_name       = yt_id+'+'+class_id+'+'+obj_id
-
-  # Find the clip in vids
-  clip = next((x for x in clips if x.name == clip_name), None)
-  assert(clip != None), \
-    "Annotation doesn't have a corresponding clip"
-
-  # Convert the annotation time stamp (in original video) to a time in the clip
-  annot_time  = float(annot[1])
-  clip_start  = float(clip.start)
-  decode_time = annot_time - clip_start
-
-  # Make the class directory if it doesn't already exist
-  frame_dest = dest_dir+'/'+d_set+'/'+str(class_id)+'/'
-  if not os.path.exists(frame_dest):
-      os.makedirs(frame_dest)
-
-  # Extract a frame at that time stamp to the appropriate place within the
-  # destination directory
-  frame_name = yt_id+'+'+class_id+'+'+obj_id+'+'+str(int(annot_time))+'.jpg'
-  FNULL = open(os.devnull, 'w')
-  check_call(['ffmpeg',\
-      '-ss', str(float(decode_time)/1000.0),\
-      '-i', (annot_clip_path+annot_clip_name),\
-      '-qscale:v','2',\
-      '-vframes','1',\
-      '-threads','1',\
-      (frame_dest+frame_name)],\
-      stdout=FNULL,stderr=subprocess.STDOUT )
-
-  with Image.open(frame_dest+frame_name) as img:
-          width, height = img.size
-  # If this frame's aspect ratio exheeds the maximum aspect ratio
-  if ( (max_ratio!=0) and \
-         ( ((width/height) > max_ratio) or
-           ((height/width) > max_ratio) ) ):
-      os.remove(frame_dest+frame_name)
+
+## Decode all the annotated frames of a given clip. Returns an
+## (annotation, width, height) tuple for each frame which was kept. The
+## clip's dimensions come from the probe cache `probes`.
+def decode_clip(clip,
+                annots,
+                max_ratio,
+                d_set,
+                src_dir,
+                dest_dir,
+                shards=None,
+                probes=None,
+                threads=1):
+  annot_clip_path = src_dir+'/'+d_set+'/'+clip.class_id+'/'
+  annot_clip_name = clip.name+'.mp4'
+
+  # All frames of a clip share its dimensions, so skip the whole clip if its
+  # aspect ratio exceeds the maximum
+  if probes is None:
+    probes = youtube_bb.probe_cache()
+  info = probes.get(annot_clip_path+annot_clip_name)
+  if not youtube_bb.aspect_ok(info,max_ratio):
+    return []
+  width, height = info['width'], info['height']
+
+  # When writing shards the frames only pass through a temporary directory
+  if shards is None:
+    # Make the class directory if it doesn't already exist
+    frame_dest = dest_dir+'/'+d_set+'/'+str(clip.class_id)+'/'
+    if not os.path.exists(frame_dest):
+        os.makedirs(frame_dest, exist_ok=True)
+  else:
+    frame_dest = tempfile.mkdtemp(dir=dest_dir)+'/'
+
+  # Convert the annotation time stamps (in original video) to times in the
+  # clip, and extract the frames at those time stamps to the appropriate place
+  # within the destination directory
+  clip_start   = float(clip.start)
+  decode_times = []
+  frame_paths  = []
+  for annot in annots:
+    annot_time = float(annot[1])
+    decode_times.append(annot_time - clip_start)
+    frame_paths.append(frame_dest+clip.name+'+'+str(int(annot_time))+'.jpg')
+  try:
+    youtube_bb.decode_clip_frames(annot_clip_path+annot_clip_name,
+                                  decode_times,
+                                  frame_paths,
+                                  threads)
+
+    # Check to verify the frames were extracted
+    frames = [(annot, path) for annot, path in zip(annots,frame_paths) \
+              if os.path.exists(path)]
+
+    # Move the frames and their labels into the shards
+    if shards is not None:
+      for annot, path in frames:
+        label = json.dumps({'yt_id':      annot[0],
+                            'timestamp':  int(annot[1]),
+                            'class_id':   int(annot[2]),
+                            'class_name': annot[3],
+                            'presence':   annot[4],
+                            'width':      width,
+                            'height':     height})
+        with open(path,'rb') as f:
+          shards.add(os.path.basename(path)[:-4],
+                     {'jpg':  f.read(),
+                      'cls':  annot[2].encode('utf-8'),
+                      'json': label.encode('utf-8')})
+  finally:
+    if shards is not None:
+      shutil.rmtree(frame_dest)
+
+  return [(annot, width, height) for annot, path in frames]
 
 
 def decode_frames(d_set,
@@ -81,100 +102,202 @@ def decode_frames(d_set,
                   num_threads,
                   num_annots,
                   max_ratio,
-                  include_absent):
+                  include_absent,
+                  shards=None,
+                  shard_index=0,
+                  shard_count=1,
+                  tuner=None,
+                  sampling='random',
+                  seed=0):
   # Get list of annotations
   # Download & extract the annotation list
-  annotations,clips,vids = youtube_bb.parse_annotations(d_set,src_dir)
+  annotations,clips,vids,clip_idx = \
+    youtube_bb.parse_annotations(d_set,src_dir)
 
   # Filter out annotations with no matching video
   print(d_set + \
     ': Filtering out last, missing, and or absent frames (if requested)...')
-  present_annots = []
-  for annot in annotations:
-    yt_id    = annot[0]
-    class_id = annot[2]
-    obj_id   = '0' # Set to zero since classification task has no object
-    annot_clip_path = src_dir+'/'+d_set+'/'+class_id+'/'
-    annot_clip_name = yt_id+'+'+class_id+'+'+obj_id+'.mp4'
-    clip_name = yt_id+'+'+class_id+'+'+obj_id
-    # If video exists
-    if (os.path.exists(annot_clip_path+annot_clip_name)):
-      # If we are including all frames, or if the labeled object is present
-      if ( include_absent or (annot[4]=='present') ):
-        # If this is not the first or last frame
-        annot_clip = next((x for x in clips if x.name == clip_name), None)
-        if ((int(annot_clip.stop ) != int(annot[1])) and \
-            (int(annot_clip.start) != int(annot[1]))):
-          present_annots.append(annot)
-
-  # Gather subset of random annotations
+  keep = youtube_bb.frame_mask(annotations,clips,clip_idx,include_absent,
+                               shard_count == 1)
+
+  # Sample the frames to decode, reproducibly for a given seed. Clips whose
+  # aspect ratio exceeds the maximum are dropped before decoding, and only
+  # the clips of sampled frames are probed for their dimensions. A node
+  # shard only decodes its part of the sample of the whole data set, and only
+  # looks for its own clips.
   print(d_set+': Gathering annotations/frames to decode...')
-  random.shuffle(present_annots)
-  if num_annots == 0: # Convert all present annotations
-    annot_to_convert = present_annots
-  else:
-    assert(len(present_annots) >= num_annots), \
-      "Number of frames requested exceeds number of present frames"
-    annot_to_convert = present_annots[:num_annots]
-
-  # Run frame decoding in parallel, extract frames from each video
-  #for annot in annot_to_convert:
-  #  decode_frame(clips,annot,d_set,src_dir,dest_dir)
-  
+  probes = youtube_bb.load_probes(src_dir,d_set)
+  annot_to_convert = youtube_bb.select_frames(annotations,
+                                              clips,
+                                              clip_idx,
+                                              keep,
+                                              num_annots,
+                                              probes,
+                                              max_ratio,
+                                              num_threads,
+                                              sampling,
+                                              seed,
+                                              shard_index=shard_index,
+                                              shard_count=shard_count)
+  annot_to_convert = [annotations[idx] for idx in annot_to_convert]
+
+  # Group the annotations by clip so that each clip is only decoded once
+  clip_annots = {}
+  for annot in annot_to_convert:
+    clip_name = annot[0]+'+'+annot[2]+'+'+'0'
+    clip_annots.setdefault(clip_name,[]).append(annot)
+
+  # Run frame decoding in parallel, extract frames from each clip
+  #for clip_name, annots in clip_annots.items():
+  #  decode_clip(clip_idx.get(clip_name),annots,max_ratio,d_set,src_dir,
+  #              dest_dir,shards,probes)
+  frames = []
+  youtube_bb.stats.set_total('frames_decoded_total',len(annot_to_convert))
+  def run(*args):
+    if tuner is None:
+      return decode_clip(*args)
+    return tuner.run(decode_clip,*args,work=len(args[1]))
+  if tuner is not None:
+    num_threads = max(num_threads,tuner.max_jobs)
   with futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
-    fs = [executor.submit( \
-            decode_frame,clips,annot,max_ratio,d_set,src_dir,dest_dir) \
-            for annot in annot_to_convert]
-    for i, f in enumerate(futures.as_completed(fs)):
+    tasks = ((clip_name, (clip_idx.get(clip_name),annots,max_ratio,
+                          d_set,src_dir,dest_dir,shards,probes)) \
+             for clip_name, annots in clip_annots.items())
+    num_decoded = 0
+    for clip_name, f in youtube_bb.bounded_submit(executor,run,tasks,
+                                                  2*num_threads):
       # Check for an exception in the workers.
       try:
-        f.result()
+        frames += f.result()
       except Exception as exc:
         print('decode failed', exc)
+        youtube_bb.stats.inc('failures_total',stage='decode',
+                             cause=type(exc).__name__)
       else:
+        num_decoded += len(clip_annots[clip_name])
+        youtube_bb.stats.inc('frames_decoded_total',len(clip_annots[clip_name]))
         # Write progress to error so that it can be seen
         sys.stderr.write( \
-          "Decoded frame: {} / {} \r".format(i, len(annot_to_convert)))
-  
+          "Decoded frame: {} / {} \r".format(num_decoded,
+                                              len(annot_to_convert)))
+
+  probes.save()
   print(d_set+': Finished decoding frames!')
 
-  return annot_to_convert
+  return frames
 
 
-if __name__ == '__main__':
+description = ('Decode the labeled frames of the YouTube BoundingBoxes '
+               'classification data set.')
 
-  assert(len(sys.argv) == 8), \
-    "Usage: python3 class_decode.py [VID_SOURCE] [FRAME_DEST] [NUM_THREADS] " \
-    "[NUM_TRAIN] [NUM_VAL] [MAX_RATIO] [INCL_ABS]"
-  src_dir          = sys.argv[1]+'/'
-  dest_dir         = sys.argv[2]+'/'
-  num_threads      = int(sys.argv[3])
-  num_train_frames = int(sys.argv[4])
-  num_val_frames   = int(sys.argv[5])
-  max_ratio        = float(sys.argv[6])
-  assert((sys.argv[7]=='0')or(sys.argv[7]=='1')), \
-    ["Please indicate if frames with absent objects should be included with",
-     "a 1, or should not be included with a 0"]
-  if sys.argv[6] == '1':
-    include_absent = True
-  else:
-    include_absent = False
-
-  # Decode frames for training detection
-  train_frame_annots = decode_frames('yt_bb_classification_train',
-    src_dir,
-    dest_dir,
-    num_threads,
-    num_train_frames,
-    max_ratio,
-    include_absent)
-
-  # Decode frames for validation detection
-  val_frame_annots = decode_frames('yt_bb_classification_validation',
-    src_dir,
-    dest_dir,
-    num_threads,
-    num_val_frames,
-    max_ratio,
-    include_absent)
+# The standalone script also takes these options positionally, as NUM_THREADS
+# NUM_TRAIN NUM_VAL MAX_RATIO INCL_ABS after its directories
+positional_options = [('num_threads',int),
+                      ('num_train_frames',int),
+                      ('num_val_frames',int),
+                      ('max_ratio',float),
+                      ('include_absent',youtube_bb.flag_arg)]
+
+# Add the command line arguments to `parser`
+def add_arguments(parser):
+  parser.add_argument('src_dir', metavar='VID_SOURCE',
+    help='The source directory where you downloaded videos into')
+  parser.add_argument('dest_dir', metavar='FRAME_DEST',
+    help='The top level directory where class folders containing frames '
+         'will be')
+  parser.add_argument('--num-threads', type=int, default=4,
+    help='The number of threads to use for frame decoding (default: '
+         '%(default)s)')
+  parser.add_argument('--num-train', dest='num_train_frames', type=int,
+    default=0, metavar='N',
+    help='The number of training images to decode. Use 0 (the default) to '
+         'decode all annotated frames')
+  parser.add_argument('--num-val', dest='num_val_frames', type=int,
+    default=0, metavar='N',
+    help='The number of validation images to decode. Use 0 (the default) to '
+         'decode all annotated frames')
+  parser.add_argument('--max-ratio', type=float, default=0,
+    help='The maximum aspect ratio allowed, or 0 (the default) to allow all')
+  parser.add_argument('--include-absent', action='store_true',
+    help='Include the frames in which the object of interest is absent')
+  parser.add_argument('--shard-size', type=int, default=0, metavar='MB',
+    help='Write frames and labels into tar shards of at most this many '
+         'megabytes instead of individual files')
+  parser.add_argument('--sampling', choices=youtube_bb.sampling_modes,
+    default='random',
+    help='How the --num-train and --num-val frames are sampled: uniformly at '
+         'random, stratified by class, or balanced across classes (default: '
+         '%(default)s)')
+  parser.add_argument('--seed', type=int, default=0,
+    help='Seed of the frame sample. The same seed always selects the same '
+         'frames (default: %(default)s)')
+  youtube_bb.add_autotune_arguments(parser,'clips decoded')
+  parser.add_argument('--shard-index', type=int, default=0,
+    help='Index of the node shard of videos to decode (default: '
+         '%(default)s)')
+  parser.add_argument('--shard-count', type=int, default=1,
+    help='Number of node shards the videos are split into. Use the same '
+         'shard count as for downloading (default: %(default)s)')
+  youtube_bb.add_metrics_arguments(parser)
+
+def main(args):
+  assert(0 <= args.shard_index < args.shard_count), \
+    "Shard index must be between 0 and the shard count"
+
+  src_dir          = args.src_dir+'/'
+  dest_dir         = args.dest_dir+'/'
+  num_threads      = args.num_threads
+  num_train_frames = args.num_train_frames
+  num_val_frames   = args.num_val_frames
+  max_ratio        = args.max_ratio
+  include_absent   = args.include_absent
+
+  youtube_bb.start_metrics(args)
+  tuner = youtube_bb.make_tuner(args)
+  try:
+    for d_set, num_frames in \
+        [('yt_bb_classification_train',num_train_frames),
+         ('yt_bb_classification_validation',num_val_frames)]:
+      # The tar shards of each node shard are kept apart, and are all read
+      # back by a shard_reader of the data set
+      shard_prefix = d_set
+      if args.shard_count > 1:
+        shard_prefix += '-'+youtube_bb.node_shard_name(args.shard_index,
+                                                       args.shard_count)
+
+      # Optionally write the frames and labels into shards
+      shards = None
+      if args.shard_size > 0:
+        shards = youtube_bb.shard_writer(dest_dir+'shards',
+                                         shard_prefix,
+                                         args.shard_size<<20)
+
+      # Decode frames for classification
+      decode_frames(d_set,
+        src_dir,
+        dest_dir,
+        num_threads,
+        num_frames,
+        max_ratio,
+        include_absent,
+        shards,
+        args.shard_index,
+        args.shard_count,
+        tuner,
+        args.sampling,
+        args.seed)
+
+      if shards is not None:
+        shards.close()
+  finally:
+    # Stop the tuner and write the final metrics even when the run fails
+    if tuner is not None:
+      tuner.close()
+    youtube_bb.stats.close()
+
+if __name__ == '__main__':
 
+  parser = argparse.ArgumentParser(description=description)
+  add_arguments(parser)
+  youtube_bb.add_positional_options(parser,positional_options)
+  main(youtube_bb.parse_positional_options(parser,positional_options))
@@ -23,52 +23,154 @@
 #
 ########################################################################
 
-from subprocess import check_call
-from ffmpy import FFmpeg
-import csv
+import youtube_bb
+import argparse
 import os
 import sys
-import glob
+import time
+from concurrent import futures
 
-def decode(vid_dir='videos', frame_dir='frames'):
-  """Using the videos downloaded in `vid_dir`, produce decoded frames in
-  `frame_dir`.
+# Marker written into a clip's frame directory once all of its frames have
+# been decoded. Clips with a marker are skipped by later runs.
+done_marker = '.done'
+
+def decode_clip(clip_path, clip_out_dir, threads=1):
+  """Decode the clip at `clip_path` into 30 fps frames in `clip_out_dir`.
   """
 
-  # List the datasets
-  d_sets = [f.path for f in os.scandir(vid_dir) if f.is_dir() ]
+  # Create a directory for this clip
+  if not os.path.exists(clip_out_dir):
+    os.makedirs(clip_out_dir)
+
+  # Decode the video into 30 fps frames with ffmpeg, straight into the
+  # output directory. Frames of an interrupted run are overwritten.
+  start = time.time()
+  youtube_bb.run_ffmpeg(['ffmpeg', '-y', '-i', 'file:'+clip_path,
+                         '-vf', 'fps=30',
+                         '-threads', str(threads),
+                         os.path.join(clip_out_dir,'frame_%06d.jpg')])
+  num_frames = len([name for name in os.listdir(clip_out_dir) \
+                    if name.endswith('.jpg')])
+  if num_frames:
+    youtube_bb.stats.observe('decode_frame_seconds',
+                             (time.time()-start)/num_frames,num_frames)
+  youtube_bb.stats.inc('frames_decoded_total',num_frames)
 
-  # For each dataset
-  for d_set in d_sets:
+  # Mark the clip as fully decoded
+  open(os.path.join(clip_out_dir,done_marker),'w').close()
 
-    # List the classes
-    classes = [f.path for f in os.scandir(d_set) if f.is_dir() ]
+def list_clips(vid_dir, frame_dir):
+  """List (clip_path, clip_out_dir) of all clips in `vid_dir` which have not
+  yet been fully decoded into `frame_dir`.
+  """
 
-    # For each class
-    for class_ in classes:
+  clips   = []
+  skipped = 0
 
-      # List the clips
-      clips = [f.path for f in os.scandir(class_) ]
+  # For each dataset, class and clip
+  for d_set in os.scandir(vid_dir):
+    if not d_set.is_dir():
+      continue
+    for class_ in os.scandir(d_set.path):
+      if not class_.is_dir():
+        continue
+      for clip in os.scandir(class_.path):
+        if not clip.name.endswith('.mp4'):
+          continue
+        clip_out_dir = os.path.join(frame_dir, d_set.name, class_.name,
+                                    clip.name[:-4])
+        if os.path.exists(os.path.join(clip_out_dir,done_marker)):
+          skipped += 1
+        else:
+          clips.append((clip.path,clip_out_dir))
 
-      # For each clip, where clip is the path to the clip
-      for clip in clips:
-        clip_sub_dir = (clip.replace(vid_dir,''))[:-4]
-        clip_out_dir = frame_dir + clip_sub_dir
-        clip_name    = clip.split('/')[-1][:-4]
+  return clips, skipped
 
-        # Change to the class directory (where the clip is)
-        os.chdir(class_)
+def decode(vid_dir='videos', frame_dir='frames', num_threads=4,
+           ffmpeg_threads=1, tuner=None):
+  """Using the videos downloaded in `vid_dir`, produce decoded frames in
+  `frame_dir`. Clips are decoded in parallel by `num_threads` workers and
+  clips which were fully decoded by a previous run are skipped. With an
+  autotuner `tuner`, it sets how many clips are decoded at once and how many
+  threads each ffmpeg uses instead.
+  """
 
-        # Decode the video into 30 fps frames with ffmpeg
-        check_call(['ffmpeg', '-i', 'file:'+clip_name+'.mp4', '-vf', 'fps=30',
-                    'frame_%06d.jpg'])
+  clips, skipped = list_clips(vid_dir,frame_dir)
+  print('Decoding '+str(len(clips))+' clips ('+str(skipped)+ \
+        ' already decoded)')
 
-        # Create a directory for this clip
-        check_call(['mkdir', '-p', clip_out_dir])
+  youtube_bb.stats.set_total('clips_decoded_total',len(clips))
+  if tuner is not None:
+    num_threads = max(num_threads,tuner.max_jobs)
+  def run(clip_path,clip_out_dir):
+    if tuner is None:
+      return decode_clip(clip_path,clip_out_dir,ffmpeg_threads)
+    return tuner.run(decode_clip,clip_path,clip_out_dir)
+  with futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+    tasks = ((clip_path, (clip_path,clip_out_dir)) \
+             for clip_path, clip_out_dir in clips)
+    num_decoded = 0
+    num_failed  = 0
+    for clip_path, f in youtube_bb.bounded_submit(executor,run,tasks,
+                                                  2*num_threads):
+      # Check for an exception in the workers.
+      try:
+        f.result()
+      except Exception as exc:
+        num_failed += 1
+        print('decode failed', exc)
+        youtube_bb.stats.inc('failures_total',stage='decode',
+                             cause=type(exc).__name__)
+      else:
+        num_decoded += 1
+        youtube_bb.stats.inc('clips_decoded_total')
+        # Write progress to error so that it can be seen
+        sys.stderr.write( \
+          "Decoded clip: {} / {} \r".format(num_decoded,len(clips)))
 
-        # Move the results to the output directory
-        for jpg in glob.glob('*.jpg'):
-          check_call(['mv', jpg, clip_out_dir])
+  print('Finished decoding clips! ('+str(num_failed)+' failed)')
+
+description = ('Decode the downloaded YouTube BoundingBoxes clips into '
+               '30 fps frames.')
+
+# The standalone script also takes the number of clips to decode at once
+# positionally, as NUM_THREADS after the directories
+positional_options = [('num_threads',int)]
+
+# Add the command line arguments to `parser`
+def add_arguments(parser):
+  parser.add_argument('vid_dir', metavar='VID_DIR', nargs='?',
+    default='videos',
+    help='Directory the clips were downloaded into (default: %(default)s)')
+  parser.add_argument('frame_dir', metavar='FRAME_DIR', nargs='?',
+    default='frames',
+    help='Directory to write the frames into (default: %(default)s)')
+  parser.add_argument('--num-threads', type=int, default=4,
+    help='Number of clips to decode at once (default: %(default)s)')
+  parser.add_argument('--ffmpeg-threads', type=int, default=1,
+    help='Number of threads each ffmpeg uses (default: %(default)s)')
+  youtube_bb.add_autotune_arguments(parser,'clips decoded',
+                                    '--num-threads and --ffmpeg-threads')
+  youtube_bb.add_metrics_arguments(parser)
+
+def main(args):
+  youtube_bb.start_metrics(args)
+  tuner = youtube_bb.make_tuner(args,args.ffmpeg_threads)
+  try:
+    decode(args.vid_dir,
+           args.frame_dir,
+           args.num_threads,
+           args.ffmpeg_threads,
+           tuner)
+  finally:
+    # Stop the tuner and write the final metrics even when the run fails
+    if tuner is not None:
+      tuner.close()
+    youtube_bb.stats.close()
 
 if __name__ == '__main__':
-  decode(*sys.argv[1:])
+
+  parser = argparse.ArgumentParser(description=description)
+  add_arguments(parser)
+  youtube_bb.add_positional_options(parser,positional_options)
+  main(youtube_bb.parse_positional_options(parser,positional_options))
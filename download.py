@@ -18,26 +18,177 @@
 ########################################################################
 
 import youtube_bb
-import sys
+import argparse
 from subprocess import check_call
 
 # Parse the annotation csv file and schedule downloads and cuts
-def parse_and_sched(dl_dir='videos',num_threads=4):
+def parse_and_sched(dl_dir='videos',
+                    num_threads=4,
+                    cut_mode='multi',
+                    num_dl_threads=None,
+                    max_pending=None,
+                    journal_path='',
+                    max_attempts=3,
+                    retry_unavailable=False,
+                    shard_index=0,
+                    shard_count=1,
+                    schedule='cost',
+                    tuner=None,
+                    source_dir=None,
+                    cache_dir=None,
+                    cache_size=100<<30):
   """Download the entire youtube-bb data set into `dl_dir`.
+
+  Progress is recorded in a journal at `journal_path` (by default
+  `dl_dir/journal.sqlite`) so that an interrupted run can be resumed. Pass
+  `journal_path=None` to disable the journal.
+
+  With a `shard_count` greater than one only the videos of node shard
+  `shard_index` are downloaded, so that the data set can be split across
+  machines.
+
+  With `schedule='cost'` the videos estimated to take longest to download and
+  cut are started first, and with `schedule='id'` they are started in order
+  of YouTube id.
+
+  With a `tuner` the number of clips cut at once and the number of threads
+  each ffmpeg uses are tuned by the autotuner during the run.
+
+  With a `source_dir` the source videos are taken from `source_dir/yt_id.mp4`
+  instead of being downloaded from YouTube.
+
+  With a `cache_dir` the downloaded source videos are kept in a cache of at
+  most `cache_size` bytes, so that cutting the clips again doesn't download
+  them again.
   """
 
   # Make the download directory if it doesn't already exist
   check_call(['mkdir', '-p', dl_dir])
 
-  # For each of the four datasets
-  for d_set in youtube_bb.d_sets:
-    annotations,clips,vids = youtube_bb.parse_annotations(d_set,dl_dir)
-    youtube_bb.sched_downloads(d_set,dl_dir,num_threads,vids)
+  journal = None
+  if journal_path is not None:
+    journal = youtube_bb.dl_journal(journal_path or dl_dir+'/journal.sqlite',
+                                    max_attempts,
+                                    retry_unavailable)
 
-if __name__ == '__main__':
+  fetch = youtube_bb.download_video
+  if source_dir is not None:
+    fetch = youtube_bb.local_sources(source_dir)
+  if cache_dir is not None:
+    fetch = youtube_bb.source_cache(cache_dir,cache_size,fetch)
+
+  # Estimate the cost of each video to start the most expensive ones first
+  costs = youtube_bb.cost_model() if schedule == 'cost' else None
+
+  def load_vids(d_set):
+    annotations,clips,vids,clip_idx = youtube_bb.parse_annotations(d_set,dl_dir)
+    if shard_count > 1:
+      vids = youtube_bb.node_shard_vids(vids,shard_index,shard_count)
+    return vids
 
-  assert(len(sys.argv) == 3), \
-          "Usage: python download.py [VIDEO_DIR] [NUM_THREADS]"
+  # Parse the four datasets in the background while downloading. Videos
+  # which appear in more than one of them are downloaded once.
+  try:
+    youtube_bb.stream_downloads(youtube_bb.d_sets,dl_dir,num_threads,
+                                load_vids,cut_mode,num_dl_threads,max_pending,
+                                journal,costs,tuner,fetch)
+  finally:
+    if journal is not None:
+      journal.close()
+
+description = 'Download and cut the YouTube BoundingBoxes videos.'
+
+# The standalone script also takes the number of threads positionally, as
+# NUM_THREADS after the video directory
+positional_options = [('num_threads',int)]
+
+# Add the command line arguments to `parser`. With `cut` the source videos
+# are cut from a local directory instead of being downloaded.
+def add_arguments(parser,cut=False):
+  if cut:
+    parser.add_argument('source_dir', metavar='SOURCE_DIR',
+      help='Directory holding the source videos, named YT_ID.mp4')
   # Use the directory `videos` in the current working directory by
   # default, or a directory specified on the command line.
-  parse_and_sched(sys.argv[1],int(sys.argv[2]))
+  parser.add_argument('vid_dir', metavar='VIDEO_DIR',
+    help='Directory to download videos into')
+  parser.add_argument('--num-threads', type=int, default=4,
+    help='Number of threads to use for cutting, and by default for '
+         'downloading (default: %(default)s)')
+  parser.add_argument('--cut-mode', choices=youtube_bb.cut_modes,
+    default='multi',
+    help='How clips are cut from each video (default: %(default)s)')
+  parser.add_argument('--download-threads', type=int, default=None,
+    help='Number of threads to use for downloading (default: --num-threads)')
+  parser.add_argument('--max-pending', type=int, default=None,
+    help='Maximum number of videos downloading, waiting to be cut or being '
+         'cut at once. Bounds the number of temporary videos on disk '
+         '(default: download threads + 2 * --num-threads)')
+  parser.add_argument('--journal', default='',
+    help='Path of the download journal (default: VIDEO_DIR/journal.sqlite)')
+  parser.add_argument('--no-journal', action='store_true',
+    help='Neither read nor write the download journal')
+  parser.add_argument('--max-attempts', type=int, default=3,
+    help='Number of times to try a video before giving up on it '
+         '(default: %(default)s)')
+  parser.add_argument('--retry-unavailable', action='store_true',
+    help='Retry videos which were unavailable on YouTube in previous runs')
+  parser.add_argument('--schedule', choices=['cost','id'], default='cost',
+    help='Start the videos estimated to take longest first (cost), or go '
+         'in order of YouTube id (id) (default: %(default)s)')
+  youtube_bb.add_autotune_arguments(parser,'clips cut')
+  parser.add_argument('--shard-index', type=int, default=0,
+    help='Index of the node shard of videos to download (default: '
+         '%(default)s)')
+  parser.add_argument('--shard-count', type=int, default=1,
+    help='Number of node shards the videos are split into. Each video '
+         'belongs to the shard given by a hash of its YouTube id '
+         '(default: %(default)s)')
+  parser.add_argument('--source-cache', nargs='?', default=None,
+    const=youtube_bb.cache_dir+'/sources', metavar='DIR',
+    help='Keep the downloaded source videos in a cache in DIR (default: '
+         '%(const)s), and cut from the cache instead of downloading again')
+  parser.add_argument('--source-cache-size', type=float, default=100,
+    metavar='GB',
+    help='Size of the source video cache. The least recently used videos '
+         'are removed beyond it (default: %(default)s)')
+  youtube_bb.add_metrics_arguments(parser)
+  if not cut:
+    parser.add_argument('--source-dir', default=None,
+      help='Take the source videos from this directory, where they are named '
+           'YT_ID.mp4, instead of downloading them')
+
+def main(args):
+  assert(0 <= args.shard_index < args.shard_count), \
+    "Shard index must be between 0 and the shard count"
+
+  youtube_bb.start_metrics(args)
+  tuner = youtube_bb.make_tuner(args)
+  try:
+    parse_and_sched(args.vid_dir,
+                    args.num_threads,
+                    args.cut_mode,
+                    args.download_threads,
+                    args.max_pending,
+                    None if args.no_journal else args.journal,
+                    args.max_attempts,
+                    args.retry_unavailable,
+                    args.shard_index,
+                    args.shard_count,
+                    args.schedule,
+                    tuner,
+                    args.source_dir,
+                    args.source_cache,
+                    int(args.source_cache_size*(1<<30)))
+  finally:
+    # Stop the tuner and write the final metrics even when the run fails
+    if tuner is not None:
+      tuner.close()
+    youtube_bb.stats.close()
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(description=description)
+  add_arguments(parser)
+  youtube_bb.add_positional_options(parser,positional_options)
+  main(youtube_bb.parse_positional_options(parser,positional_options))
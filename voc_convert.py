@@ -18,63 +18,170 @@
 from __future__ import unicode_literals
 import youtube_bb
 import sys
-import random
+import argparse
+import shutil
+import tempfile
 import os
-import csv
-import subprocess
-from xml.etree.ElementTree import Element, SubElement, Comment, tostring
-from xml.dom import minidom
-from PIL import Image
+import json
+import threading
 from concurrent import futures
 from subprocess import check_call
 
-## Decode all the clips in a given vid
-def decode_frame(clips,
-                 annot,
-                 max_ratio,
-                 d_set,
-                 src_dir,
-                 dest_dir):
-  yt_id    = annot[0]
-  class_id = annot[2]
-  obj_id   = annot[4]
-  annot_clip_path = src_dir+'/'+d_set+'/'+class_id+'/'
-  annot_clip_name = yt_id+'+'+class_id+'+'+obj_id+'.mp4'
-  clip_name       = yt_id+'+'+class_id+'+'+obj_id
-
-  # Find the clip in vids
-  clip = next((x for x in clips if x.name == clip_name), None)
-  assert(clip != None), \
-    "Annotation doesn't have a corresponding clip"
-
-  # Convert the annotation time stamp (in original video) to a time in the clip
-  annot_time  = float(annot[1])
-  clip_start  = float(clip.start)
-  decode_time = annot_time - clip_start
-
-  # Extract a frame at that time stamp to the appropriate place within the
-  # destination directory
-  frame_dest = dest_dir+'/youtubebbdevkit2017/youtubebb2017/JPEGImages/'
-  frame_name = yt_id+'+'+class_id+'+'+obj_id+'+'+str(int(annot_time))+'.jpg'
-  FNULL = open(os.devnull, 'w')
-  check_call(['ffmpeg',\
-      '-ss', str(float(decode_time)/1000.0),\
-      '-i', (annot_clip_path+annot_clip_name),\
-      '-qscale:v','2',\
-      '-vframes','1',\
-      '-threads','1',\
-      (frame_dest+frame_name)],\
-      stdout=FNULL,stderr=subprocess.STDOUT )
-
-  with Image.open(frame_dest+frame_name) as img:
-          width, height = img.size
-  # If this frame's aspect ratio exheeds the maximum aspect ratio
-  if ( (max_ratio!=0) and \
-         ( ((width/height) > max_ratio) or
-           ((height/width) > max_ratio) ) ):
-      os.remove(frame_dest+frame_name)
+## Decode all the annotated frames of a given clip and write their xml
+## annotations as soon as the frames exist. Returns the xml annotation
+## parameters of each frame which was kept. The clip's dimensions come from
+## the probe cache `probes`.
+def decode_clip(clip,
+                annots,
+                max_ratio,
+                d_set,
+                src_dir,
+                dest_dir,
+                shards=None,
+                probes=None,
+                threads=1):
+  annot_clip_path = src_dir+'/'+d_set+'/'+clip.class_id+'/'
+  annot_clip_name = clip.name+'.mp4'
+
+  # All frames of a clip share its dimensions, so skip the whole clip if its
+  # aspect ratio exceeds the maximum
+  if probes is None:
+    probes = youtube_bb.probe_cache()
+  info = probes.get(annot_clip_path+annot_clip_name)
+  if not youtube_bb.aspect_ok(info,max_ratio):
+    return []
+  width, height = info['width'], info['height']
+
+  # When writing shards the frames only pass through a temporary directory
+  if shards is None:
+    frame_dest = dest_dir+'/youtubebbdevkit2017/youtubebb2017/JPEGImages/'
+  else:
+    frame_dest = tempfile.mkdtemp(dir=dest_dir)+'/'
+
+  # Convert the annotation time stamps (in original video) to times in the
+  # clip, and extract the frames at those time stamps to the appropriate place
+  # within the destination directory
+  clip_start   = float(clip.start)
+  decode_times = []
+  frame_paths  = []
+  for annot in annots:
+    annot_time = float(annot[1])
+    decode_times.append(annot_time - clip_start)
+    frame_paths.append(frame_dest+clip.name+'+'+str(int(annot_time))+'.jpg')
+  try:
+    youtube_bb.decode_clip_frames(annot_clip_path+annot_clip_name,
+                                  decode_times,
+                                  frame_paths,
+                                  threads)
+
+    # Check to verify the frames were extracted, and write the annotations
+    # of those that were. Sharded frames are moved into the shards along
+    # with their annotations.
+    xml_annots = []
+    for annot, path in zip(annots,frame_paths):
+      if not os.path.exists(path):
+        continue
+      xml_params = make_xml_annot(annot,width,height)
+      if shards is None:
+        write_xml_annot(dest_dir,xml_params)
+      else:
+        with open(path,'rb') as f:
+          shards.add(xml_params.annot_name,
+                     {'jpg': f.read(),
+                      'xml': xml_annot_str(xml_params).encode('utf-8')})
+      xml_annots.append(xml_params)
+  finally:
+    if shards is not None:
+      shutil.rmtree(frame_dest)
 
+  return xml_annots
 
+# The name of the frame and xml annotation of an annotation, as given by
+# make_xml_annot
+def frame_name(annot):
+  return annot[0]+'+'+annot[2]+'+'+annot[4]+'+'+annot[1]
+
+# Remove the frames and xml annotations named `annot_names`
+def remove_frames(dest_dir,annot_names):
+  voc_dir = dest_dir+'youtubebbdevkit2017/youtubebb2017/'
+  for annot_name in annot_names:
+    for path in [voc_dir+'JPEGImages/'+annot_name+'.jpg',
+                 voc_dir+'Annotations/'+annot_name+'.xml']:
+      if os.path.exists(path):
+        os.remove(path)
+
+# Manifest of the frames converted by previous runs, for converting
+# incrementally. For every clip it records the size and modification time of
+# the source clip, the clip's dimensions and the annotation of every frame
+# converted from it. plan() compares the frames to convert with the manifest,
+# removes the outputs which are no longer wanted, and returns the frames which
+# still need decoding. record() adds the frames of a clip once decoded.
+class convert_manifest(object):
+  def __init__(self,path):
+    self.path = path
+    try:
+      with open(path) as f:
+        self.d_sets = json.load(f)
+    except (IOError, ValueError):
+      self.d_sets = {}
+    self.sources = {}
+    self.lock    = threading.Lock()
+
+  def plan(self,d_set,clip_annots,clip_idx,src_dir,dest_dir):
+    entries = self.d_sets.setdefault(d_set,{})
+    # Remove the frames of clips which are no longer converted at all
+    for clip_name in list(entries):
+      if clip_name not in clip_annots:
+        remove_frames(dest_dir,entries.pop(clip_name)['frames'])
+
+    reused = []
+    todo   = {}
+    for clip_name, annots in clip_annots.items():
+      clip   = clip_idx.get(clip_name)
+      stat   = os.stat(src_dir+'/'+d_set+'/'+clip.class_id+'/'+clip.name+'.mp4')
+      source = [stat.st_size, stat.st_mtime_ns]
+      self.sources[(d_set,clip_name)] = source
+      wanted = dict((frame_name(annot), ','.join(annot)) for annot in annots)
+      entry  = entries.get(clip_name)
+      if entry is None:
+        todo[clip_name] = annots
+        continue
+      # Every frame of a changed clip is decoded again. Otherwise only the
+      # frames whose annotation changed, or which are new, are decoded.
+      done = entry['frames']
+      if entry['source'] == source:
+        stale = [name for name in done if wanted.get(name) != done[name]]
+      else:
+        stale = list(done)
+      remove_frames(dest_dir,stale)
+      for name in stale:
+        del done[name]
+      new = []
+      for annot in annots:
+        if frame_name(annot) in done:
+          reused.append(make_xml_annot(annot,entry['width'],entry['height']))
+        else:
+          new.append(annot)
+      if new:
+        todo[clip_name] = new
+    return reused, todo
+
+  def record(self,d_set,clip_name,xml_annots):
+    with self.lock:
+      entry = self.d_sets[d_set].setdefault(clip_name,{'frames': {}})
+      entry['source'] = self.sources[(d_set,clip_name)]
+      for xml_params in xml_annots:
+        entry['width']  = int(xml_params.image_width)
+        entry['height'] = int(xml_params.image_height)
+        entry['frames'][xml_params.annot_name] = xml_params.annotation
+
+  def save(self):
+    # Write the manifest atomically so that an interrupted run can't leave a
+    # partial manifest behind
+    with self.lock:
+      with open(self.path+'.tmp','w') as f:
+        json.dump(self.d_sets,f)
+      os.replace(self.path+'.tmp',self.path)
 
 def decode_frames(d_set,
                   src_dir,
@@ -82,307 +189,492 @@ def decode_frames(d_set,
                   num_threads,
                   num_annots,
                   max_ratio,
-                  include_absent):
+                  include_absent,
+                  shards=None,
+                  shard_index=0,
+                  shard_count=1,
+                  tuner=None,
+                  sampling='random',
+                  seed=0,
+                  manifest=None,
+                  annot_dir=None):
   # Get list of annotations
   # Download & extract the annotation list
-  annotations,clips,vids = youtube_bb.parse_annotations(d_set,src_dir)
+  annotations,clips,vids,clip_idx = \
+    youtube_bb.parse_annotations(d_set,src_dir,annot_dir)
 
   # Filter out annotations with no matching video
   print(d_set + \
     ': Filtering out last, missing, and or absent frames (if requested)...')
-  present_annots = []
-  for annot in annotations:
-    yt_id    = annot[0]
-    class_id = annot[2]
-    obj_id   = annot[4]
-    annot_clip_path = src_dir+'/'+d_set+'/'+class_id+'/'
-    annot_clip_name = yt_id+'+'+class_id+'+'+obj_id+'.mp4'
-    clip_name = yt_id+'+'+class_id+'+'+obj_id
-    # If video exists
-    if (os.path.exists(annot_clip_path+annot_clip_name)):
-      # If we are including all frames, or if the labeled object is present
-      if ( include_absent or (annot[5]=='present') ):
-        # If this is not the first or last frame
-        annot_clip = next((x for x in clips if x.name == clip_name), None)
-        if ((int(annot_clip.stop ) != int(annot[1])) and \
-            (int(annot_clip.start) != int(annot[1]))):
-          present_annots.append(annot)
-
-  # Gather subset of random annotations
+  keep = youtube_bb.frame_mask(annotations,clips,clip_idx,include_absent,
+                               shard_count == 1)
+
+  # Sample the frames to decode, reproducibly for a given seed. Clips whose
+  # aspect ratio exceeds the maximum are dropped before decoding, and only
+  # the clips of sampled frames are probed for their dimensions. A node
+  # shard only decodes its part of the sample of the whole data set, and only
+  # looks for its own clips.
   print(d_set+': Gathering annotations/frames to decode...')
-  random.shuffle(present_annots)
-  if num_annots == 0: # Convert all present annotations
-    annot_to_convert = present_annots
-  else:
-    assert(len(present_annots) >= num_annots), \
-      "Number of frames requested exceeds number of present frames"
-    annot_to_convert = present_annots[:num_annots]
-
-  # Run frame decoding in parallel, extract frames from each video
-  #for annot in annot_to_convert:
-  #  decode_frame(clips,annot,d_set,src_dir,dest_dir)
+  probes = youtube_bb.load_probes(src_dir,d_set)
+  annot_to_convert = youtube_bb.select_frames(annotations,
+                                              clips,
+                                              clip_idx,
+                                              keep,
+                                              num_annots,
+                                              probes,
+                                              max_ratio,
+                                              num_threads,
+                                              sampling,
+                                              seed,
+                                              shard_index=shard_index,
+                                              shard_count=shard_count)
+  annot_to_convert = [annotations[idx] for idx in annot_to_convert]
+
+  # Group the annotations by clip so that each clip is only decoded once
+  clip_annots = {}
+  for annot in annot_to_convert:
+    clip_name = annot[0]+'+'+annot[2]+'+'+annot[4]
+    clip_annots.setdefault(clip_name,[]).append(annot)
+
+  # When converting incrementally only decode the frames which previous runs
+  # haven't already converted
+  xml_annots = []
+  if manifest is not None:
+    xml_annots, clip_annots = manifest.plan(d_set,clip_annots,clip_idx,
+                                            src_dir,dest_dir)
+    print(d_set+': '+str(len(xml_annots))+ \
+          ' frames already converted by previous runs')
+  num_annots = sum(len(annots) for annots in clip_annots.values())
+
+  # Run frame decoding in parallel, extract frames from each clip
+  #for clip_name, annots in clip_annots.items():
+  #  decode_clip(clip_idx.get(clip_name),annots,max_ratio,d_set,src_dir,
+  #              dest_dir,shards,probes)
+  youtube_bb.stats.set_total('frames_decoded_total',num_annots)
+  def run(*args):
+    if tuner is None:
+      return decode_clip(*args)
+    return tuner.run(decode_clip,*args,work=len(args[1]))
+  if tuner is not None:
+    num_threads = max(num_threads,tuner.max_jobs)
   with futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
-    fs = [executor.submit( \
-            decode_frame,clips,annot,max_ratio,d_set,src_dir,dest_dir) \
-            for annot in annot_to_convert]
-    for i, f in enumerate(futures.as_completed(fs)):
+    tasks = ((clip_name, (clip_idx.get(clip_name),annots,max_ratio,
+                          d_set,src_dir,dest_dir,shards,probes)) \
+             for clip_name, annots in clip_annots.items())
+    num_decoded = 0
+    for clip_name, f in youtube_bb.bounded_submit(executor,run,tasks,
+                                                  2*num_threads):
       # Check for an exception in the workers.
       try:
-        f.result()
+        decoded = f.result()
+        xml_annots += decoded
+        if manifest is not None:
+          manifest.record(d_set,clip_name,decoded)
       except Exception as exc:
         print('decode failed', exc)
+        youtube_bb.stats.inc('failures_total',stage='decode',
+                             cause=type(exc).__name__)
       else:
+        num_decoded += len(clip_annots[clip_name])
+        youtube_bb.stats.inc('frames_decoded_total',len(clip_annots[clip_name]))
         # Write progress to error so that it can be seen
         sys.stderr.write( \
-          "Decoded frame: {} / {} \r".format(i, len(annot_to_convert)))
+          "Decoded frame: {} / {} \r".format(num_decoded,num_annots))
 
+  probes.save()
+  if manifest is not None:
+    manifest.save()
   print(d_set+': Finished decoding frames!')
 
-  return annot_to_convert
-
-def write_xml_annot(dest_dir,xml_params):
-  # Write the xml annotation to file
-  xml_annot = Element('annotation')
-
-  folder = SubElement(xml_annot, 'folder')
-  folder.text = xml_params.folder
-
-  filename = SubElement(xml_annot, 'filename')
-  filename.text = xml_params.filename
-
-  source = SubElement(xml_annot, 'source')
-  database = SubElement(source, 'database')
-  database.text = xml_params.database
-  annotation = SubElement(source, 'annotation')
-  annotation.text = xml_params.annotation
-  image_source = SubElement(source, 'image')
-  image_source.text = xml_params.image_source
-  image_flickrid = SubElement(source, 'flickrid')
-  image_flickrid.text = xml_params.image_flickrid
-
-  owner = SubElement(xml_annot, 'owner')
-  owner_flickrid = SubElement(owner, 'flickrid')
-  owner_flickrid.text = xml_params.owner_flickrid
-  owner_name = SubElement(owner, 'name')
-  owner_name.text = xml_params.owner_name
-
-  size = SubElement(xml_annot, 'size')
-  width = SubElement(size, 'width')
-  width.text = xml_params.image_width
-  height = SubElement(size, 'height')
-  height.text = xml_params.image_height
-  depth = SubElement(size, 'depth')
-  depth.text = xml_params.image_depth
-
-  segmented = SubElement(xml_annot, 'segmented')
-  segmented.text = xml_params.segmented
+  return xml_annots
 
+# Template of the xml annotation. The layout and escaping match the output of
+# ElementTree serialized and pretty printed by minidom with an indent of three
+# spaces, which is how the annotations used to be built, but the template is
+# far cheaper to fill in.
+xml_template = """<?xml version="1.0" ?>
+<annotation>
+   <folder>{folder}</folder>
+   <filename>{filename}</filename>
+   <source>
+      <database>{database}</database>
+      <annotation>{annotation}</annotation>
+      <image>{image_source}</image>
+      <flickrid>{image_flickrid}</flickrid>
+   </source>
+   <owner>
+      <flickrid>{owner_flickrid}</flickrid>
+      <name>{owner_name}</name>
+   </owner>
+   <size>
+      <width>{image_width}</width>
+      <height>{image_height}</height>
+      <depth>{image_depth}</depth>
+   </size>
+   <segmented>{segmented}</segmented>
+{object_}</annotation>
+"""
+xml_object_template = """   <object>
+      <name>{class_name}</name>
+      <pose>{pose}</pose>
+      <truncated>{truncated}</truncated>
+      <difficult>{difficult}</difficult>
+      <bndbox>
+         <xmin>{xmin}</xmin>
+         <ymin>{ymin}</ymin>
+         <xmax>{xmax}</xmax>
+         <ymax>{ymax}</ymax>
+      </bndbox>
+   </object>
+"""
+
+def xml_escape(text):
+  # Escape text the same way as minidom
+  return text.replace("&", "&amp;").replace("<", "&lt;"). \
+              replace("\"", "&quot;").replace(">", "&gt;")
+
+def xml_annot_str(xml_params):
+  # Fill in the xml annotation template
+  fields = dict((name, xml_escape(value)) \
+                for name, value in vars(xml_params).items())
   if ('present' in xml_params.annotation):
-    object_ = SubElement(xml_annot, 'object')
-    class_name = SubElement(object_, 'name')
-    class_name.text = xml_params.class_name
-    pose = SubElement(object_, 'pose')
-    pose.text = xml_params.pose
-    truncated = SubElement(object_, 'truncated')
-    truncated.text = xml_params.truncated
-    difficult = SubElement(object_, 'difficult')
-    difficult.text = xml_params.difficult
-    bndbox = SubElement(object_, 'bndbox')
-    xmin = SubElement(bndbox, 'xmin')
-    xmin.text = xml_params.xmin
-    ymin = SubElement(bndbox, 'ymin')
-    ymin.text = xml_params.ymin
-    xmax = SubElement(bndbox, 'xmax')
-    xmax.text = xml_params.xmax
-    ymax = SubElement(bndbox, 'ymax')
-    ymax.text = xml_params.ymax
+    fields['object_'] = xml_object_template.format(**fields)
+  else:
+    fields['object_'] = ''
+  return xml_template.format(**fields)
 
+def write_xml_annot(dest_dir,xml_params):
   # Write the XML file
-  xml_str = minidom.parseString(tostring(xml_annot)).toprettyxml(indent="   ")
+  xml_str = xml_annot_str(xml_params)
   with open(dest_dir + \
             'youtubebbdevkit2017/youtubebb2017/Annotations/' + \
             xml_params.annot_name + \
             '.xml', 'w') as f:
     f.write(xml_str)
 
-def write_xml_annots(dest_dir,annots):
-  xml_annots = []
-  # For each annotation
-  for annot in annots:
-    # Get file details
-    yt_id      = annot[0]
-    annot_time = annot[1]
-    class_id   = annot[2]
-    obj_id     = annot[4]
-    annot_name = yt_id+'+'+class_id+'+'+obj_id+'+'+annot_time
-    filename   = annot_name+'.jpg'
-    frame_path = dest_dir + 'youtubebbdevkit2017/youtubebb2017/JPEGImages/'
-
-    # Check to verify the frame was extracted
-    if (os.path.exists(frame_path+filename)):
-      # Get image dimensions
-      img = Image.open(frame_path+filename)
-      image_width,image_height  = img.size
-
-      # Check to see if this annotation is on the border
-      # (likely a truncated annotation)
-      xmin_frac = float(annot[6])
-      xmax_frac = float(annot[7])
-      ymin_frac = float(annot[8])
-      ymax_frac = float(annot[9])
-      if ( (xmin_frac == 0.0) or (xmax_frac == 1.0) or \
-              (ymin_frac == 0.0) or (ymax_frac == 1.0) ):
-        truncated = 1
-      else:
-        truncated = 0
-
-      # Convert bounding boxes to pixel dimensions, set minimum as 1
-      xmin_pix = int(float(image_width)*xmin_frac)
-      if xmin_pix == 0: xmin_pix = 1
-      ymin_pix = int(float(image_height)*ymin_frac)
-      if ymin_pix == 0: ymin_pix = 1
-      xmax_pix = int(float(image_width)*xmax_frac)
-      ymax_pix = int(float(image_height)*ymax_frac)
-
-      xml_params = youtube_bb.xml_annot( \
-        annot_name,
-        filename,
-        annot,
-        image_width,
-        image_height,
-        truncated,
-        xmin_pix,
-        ymin_pix,
-        xmax_pix,
-        ymax_pix)
-
-      write_xml_annot(dest_dir,xml_params)
-      xml_annots.append(xml_params)
-  return xml_annots
-
-
-def write_class_det_files(dest_dir, filename, xml_annots):
-  out_file =  open((dest_dir + \
-                    'youtubebbdevkit2017/youtubebb2017/ImageSets/Main/' + \
-                    filename),
-                    "w")
-  for Layout_annot in xml_annots:
-    out_file.write(Layout_annot.annot_name+'\n')
-  out_file.close()
-
-def write_class_files(dest_dir, filename, xml_annots, class_):
-  out_file =  open((dest_dir + \
-                    'youtubebbdevkit2017/youtubebb2017/ImageSets/Main/' + \
-                    filename),
-                   "w")
-  # If this is not an empty list
-  for Main_annot in xml_annots:
-    if ((Main_annot.class_name == class_[1]) and \
-        ('present' in Main_annot.annotation)):
+def make_xml_annot(annot,image_width,image_height):
+  # Get file details
+  yt_id      = annot[0]
+  annot_time = annot[1]
+  class_id   = annot[2]
+  obj_id     = annot[4]
+  annot_name = yt_id+'+'+class_id+'+'+obj_id+'+'+annot_time
+  filename   = annot_name+'.jpg'
+
+  # Check to see if this annotation is on the border
+  # (likely a truncated annotation)
+  xmin_frac = float(annot[6])
+  xmax_frac = float(annot[7])
+  ymin_frac = float(annot[8])
+  ymax_frac = float(annot[9])
+  if ( (xmin_frac == 0.0) or (xmax_frac == 1.0) or \
+          (ymin_frac == 0.0) or (ymax_frac == 1.0) ):
+    truncated = 1
+  else:
+    truncated = 0
+
+  # Convert bounding boxes to pixel dimensions, set minimum as 1
+  xmin_pix = int(float(image_width)*xmin_frac)
+  if xmin_pix == 0: xmin_pix = 1
+  ymin_pix = int(float(image_height)*ymin_frac)
+  if ymin_pix == 0: ymin_pix = 1
+  xmax_pix = int(float(image_width)*xmax_frac)
+  ymax_pix = int(float(image_height)*ymax_frac)
+
+  return youtube_bb.xml_annot( \
+    annot_name,
+    filename,
+    annot,
+    image_width,
+    image_height,
+    truncated,
+    xmin_pix,
+    ymin_pix,
+    xmax_pix,
+    ymax_pix)
+
+
+# NOTE:
+# VOC converted test: YouTube BoundingBox validation
+# VOC converted train: YouTube BoundingBox training
+# VOC converted validation: Empty
+d_set_sections = ['test',
+                  'train',
+                  'trainval',
+                  'val',
+                  ]
+
+# Directory of the ImageSets/Main files, or of the ImageSets/Main files of one
+# node shard. The files of every node shard are combined by merge_imagesets.
+def imagesets_dir(dest_dir,shard_index=0,shard_count=1):
+  main_dir = dest_dir+'youtubebbdevkit2017/youtubebb2017/ImageSets/Main/'
+  if shard_count > 1:
+    main_dir += youtube_bb.node_shard_name(shard_index,shard_count)+'/'
+  return main_dir
+
+# Combine the ImageSets/Main files written by each of `shard_count` node
+# shards. Every frame belongs to exactly one node shard, so the files of the
+# shards are simply concatenated. The manifest of each node shard must exist,
+# which guarantees that its files are complete.
+def merge_imagesets(dest_dir,shard_count):
+  main_dir   = imagesets_dir(dest_dir)
+  shard_dirs = [imagesets_dir(dest_dir,shard_index,shard_count) \
+                for shard_index in range(shard_count)]
+  missing = [shard_dir for shard_dir in shard_dirs \
+             if not os.path.exists(shard_dir+'manifest.json')]
+  assert(len(missing) == 0), \
+    "Node shards not finished: "+', '.join(missing)
+
+  num_frames = {}
+  for shard_dir in shard_dirs:
+    with open(shard_dir+'manifest.json') as f:
+      manifest = json.load(f)
+    for d_set, frames in manifest['frames'].items():
+      num_frames[d_set] = num_frames.get(d_set,0)+frames
+  for file_name in sorted(os.listdir(shard_dirs[0])):
+    if not file_name.endswith('.txt'):
+      continue
+    with open(main_dir+file_name,'wb') as out_file:
+      for shard_dir in shard_dirs:
+        with open(shard_dir+file_name,'rb') as in_file:
+          shutil.copyfileobj(in_file,out_file)
+
+  with open(main_dir+'manifest.json','w') as f:
+    json.dump({'shard_count': shard_count, 'frames': num_frames},f,
+              indent=2,sort_keys=True)
+  return num_frames
+
+# Writes every ImageSets/Main file of the given sections at once: the
+# Classification/Detection task files (test, train, trainval, val) and the
+# Classification task files (all classes for each section). Each annotation
+# is bucketed into all of its files in a single pass. With `append` the
+# files are extended rather than replaced, so frames which are added to the
+# data set later can be appended to the existing sets.
+class imagesets_writer(object):
+  def __init__(self,dest_dir,sections=d_set_sections,append=False,
+               buffer_size=1<<20,main_dir=None):
+    if main_dir is None:
+      main_dir = imagesets_dir(dest_dir)
+    mode     = 'a' if append else 'w'
+    # Skip the None class (no examples for detection)
+    self.class_names = [class_[1] for class_ in youtube_bb.class_list \
+                        if class_[1] != 'none']
+    self.det_files   = {}
+    self.class_files = {}
+    for section in sections:
+      self.det_files[section] = open(main_dir+section+'.txt',mode,
+                                     buffering=buffer_size)
+      self.class_files[section] = \
+        [open(main_dir+class_name+'_'+section+'.txt',mode,
+              buffering=buffer_size) for class_name in self.class_names]
+
+  def add(self,sections,xml_annots):
+    det_files   = [self.det_files[section] for section in sections]
+    class_files = [self.class_files[section] for section in sections]
+    for xml_annot in xml_annots:
+      name = xml_annot.annot_name
+      for out_file in det_files:
+        out_file.write(name+'\n')
       # Class of interest is present
-      present_flag = '1'
-    else:
-      present_flag = '-1'
-    out_file.write(Main_annot.annot_name+' '+present_flag+'\n')
-  out_file.close()
-
-def write_txt_files(dest_dir, train_xml_annots, val_xml_annots):
-
-  # Get the list of classes
-  class_list = youtube_bb.class_list
-
-  # NOTE:
-  # VOC converted test: YouTube BoundingBox validation
-  # VOC converted train: YouTube BoundingBox training
-  # VOC converted validation: Empty
-  d_set_sections = ['test',
-                    'train',
-                    'trainval',
-                    'val',
-                    ]
-  section_annots = [val_xml_annots,
-                    train_xml_annots,
-                    train_xml_annots,
-                    [],
-                    ]
-  # Print Classification/Detection task files (test, train, trainval, val)
-  for idx in range(len(d_set_sections)):
-    write_class_det_files(dest_dir,
-                      (d_set_sections[idx]+'.txt'),
-                      section_annots[idx])
-
-  # Print Classification task files (all classes for each dataset)
-  for idx in range(len(d_set_sections)):
-    for class_ in class_list:
-      # Skip the None class (no examples for detection)
-      if class_[1] != 'none':
-        write_class_files(dest_dir,
-                        (class_[1]+'_'+d_set_sections[idx]+'.txt'),
-                        section_annots[idx],
-                        class_)
+      present_class = None
+      if 'present' in xml_annot.annotation:
+        present_class = xml_annot.class_name
+      absent_line  = name+' -1\n'
+      present_line = name+' 1\n'
+      for files in class_files:
+        for class_name, out_file in zip(self.class_names,files):
+          if class_name == present_class:
+            out_file.write(present_line)
+          else:
+            out_file.write(absent_line)
+
+  def close(self):
+    for section in self.det_files:
+      self.det_files[section].close()
+      for out_file in self.class_files[section]:
+        out_file.close()
+
+def write_txt_files(dest_dir, train_xml_annots, val_xml_annots, append=False,
+                    main_dir=None):
+  writer = imagesets_writer(dest_dir,append=append,main_dir=main_dir)
+  writer.add(['test'],val_xml_annots)
+  writer.add(['train','trainval'],train_xml_annots)
+  writer.close()
+
+# The VOC 2007 devkit, downloaded once and kept in the cache directory
+devkit_link = \
+  "http://host.robots.ox.ac.uk/pascal/VOC/voc2007/VOCdevkit_08-Jun-2007.tar"
+
+# The manifest of converted frames, relative to the destination directory
+manifest_path = 'youtubebbdevkit2017/youtubebb2017/manifest.json'
+
+def setup_devkit(dest_dir):
+  devkit_dir = dest_dir+'youtubebbdevkit2017'
+  if not os.path.isdir(devkit_dir):
+    # Download VOC 2007 devkit, unless an earlier run already did
+    devkit_tar = youtube_bb.cache_dir+'/'+os.path.basename(devkit_link)
+    if not os.path.exists(devkit_tar):
+      os.makedirs(youtube_bb.cache_dir, exist_ok=True)
+      check_call(['wget','-O',devkit_tar+'.tmp',devkit_link])
+      os.replace(devkit_tar+'.tmp',devkit_tar)
+
+    # Extract and rename. The devkit is extracted into a temporary directory
+    # so that an interrupted extraction isn't mistaken for a devkit.
+    extract_dir = tempfile.mkdtemp(dir=dest_dir)
+    check_call(['tar','-xf',devkit_tar,'-C',extract_dir])
+    os.rename(extract_dir+'/VOCdevkit',devkit_dir)
+    shutil.rmtree(extract_dir)
+
+  # Add missing directories
+  for sub_dir in ['youtubebb2017/ImageSets/Main',
+                  'youtubebb2017/JPEGImages',
+                  'youtubebb2017/Annotations',
+                  'results/youtubebb2017/Main']:
+    os.makedirs(devkit_dir+'/'+sub_dir, exist_ok=True)
+
+description = ('Convert the YouTube BoundingBoxes detection data set into '
+               'the VOC 2007 format.')
+
+# The standalone script also takes these options positionally, as NUM_THREADS
+# NUM_TRAIN NUM_VAL MAX_RATIO INCL_ABS after its directories
+positional_options = [('num_threads',int),
+                      ('num_train_frames',int),
+                      ('num_val_frames',int),
+                      ('max_ratio',float),
+                      ('include_absent',youtube_bb.flag_arg)]
+
+# Add the command line arguments to `parser`
+def add_arguments(parser):
+  parser.add_argument('src_dir', metavar='VID_SOURCE',
+    help='The source directory where you downloaded videos into')
+  parser.add_argument('dest_dir', metavar='DSET_DEST',
+    help='The destination directory for the converted dataset')
+  parser.add_argument('--num-threads', type=int, default=4,
+    help='The number of threads to use for frame decoding (default: '
+         '%(default)s)')
+  parser.add_argument('--num-train', dest='num_train_frames', type=int,
+    default=0, metavar='N',
+    help='The number of training images to decode. Use 0 (the default) to '
+         'decode all annotated frames')
+  parser.add_argument('--num-val', dest='num_val_frames', type=int,
+    default=0, metavar='N',
+    help='The number of validation images to decode. Use 0 (the default) to '
+         'decode all annotated frames')
+  parser.add_argument('--max-ratio', type=float, default=0,
+    help='The maximum aspect ratio allowed, or 0 (the default) to allow all')
+  parser.add_argument('--include-absent', action='store_true',
+    help='Include the frames in which the object of interest is absent')
+  parser.add_argument('--shard-size', type=int, default=0, metavar='MB',
+    help='Write frames and annotations into tar shards of at most this many '
+         'megabytes instead of individual files')
+  parser.add_argument('--sampling', choices=youtube_bb.sampling_modes,
+    default='random',
+    help='How the --num-train and --num-val frames are sampled: uniformly at '
+         'random, stratified by class, or balanced across classes (default: '
+         '%(default)s)')
+  parser.add_argument('--seed', type=int, default=0,
+    help='Seed of the frame sample. The same seed always selects the same '
+         'frames (default: %(default)s)')
+  youtube_bb.add_autotune_arguments(parser,'clips decoded')
+  parser.add_argument('--shard-index', type=int, default=0,
+    help='Index of the node shard of videos to decode (default: '
+         '%(default)s)')
+  parser.add_argument('--shard-count', type=int, default=1,
+    help='Number of node shards the videos are split into. Use the same '
+         'shard count as for downloading (default: %(default)s)')
+  parser.add_argument('--incremental', action='store_true',
+    help='Only decode the frames which previous runs into DSET_DEST have '
+         'not already converted, or whose source clip or annotation has '
+         'changed, and remove the frames which are no longer selected')
+  youtube_bb.add_metrics_arguments(parser)
+
+def main(args):
+  assert(0 <= args.shard_index < args.shard_count), \
+    "Shard index must be between 0 and the shard count"
+  assert(not (args.incremental and \
+              (args.shard_size > 0 or args.shard_count > 1))), \
+    "Incremental conversion can't be combined with tar shards or node shards"
+
+  src_dir          = args.src_dir+'/'
+  dest_dir         = args.dest_dir+'/'
+  num_threads      = args.num_threads
+  num_train_frames = args.num_train_frames
+  num_val_frames   = args.num_val_frames
+  max_ratio        = args.max_ratio
+  include_absent   = args.include_absent
+
+  youtube_bb.start_metrics(args)
+  tuner = youtube_bb.make_tuner(args)
+  try:
+    setup_devkit(dest_dir)
+
+    # Frames converted by previous runs are reused when converting
+    # incrementally
+    manifest = None
+    if args.incremental:
+      manifest = convert_manifest(dest_dir+manifest_path)
+
+    xml_annots = {}
+    for d_set, num_frames in [('yt_bb_detection_train',num_train_frames),
+                              ('yt_bb_detection_validation',num_val_frames)]:
+      # The tar shards of each node shard are kept apart, and are all read
+      # back by a shard_reader of the data set
+      shard_prefix = d_set
+      if args.shard_count > 1:
+        shard_prefix += '-'+youtube_bb.node_shard_name(args.shard_index,
+                                                       args.shard_count)
+
+      # Optionally write the frames and annotations into shards
+      shards = None
+      if args.shard_size > 0:
+        shards = youtube_bb.shard_writer( \
+          dest_dir+'youtubebbdevkit2017/youtubebb2017/shards',
+          shard_prefix,
+          args.shard_size<<20)
+
+      # Decode frames for detection and write their xml annotations
+      xml_annots[d_set] = decode_frames(d_set,
+        src_dir,
+        dest_dir,
+        num_threads,
+        num_frames,
+        max_ratio,
+        include_absent,
+        shards,
+        args.shard_index,
+        args.shard_count,
+        tuner,
+        args.sampling,
+        args.seed,
+        manifest)
+
+      if shards is not None:
+        shards.close()
+
+    # Write txt files. Node shards write their own files, which are combined
+    # with merge_imagesets once every node shard is finished.
+    main_dir = imagesets_dir(dest_dir,args.shard_index,args.shard_count)
+    os.makedirs(main_dir, exist_ok=True)
+    write_txt_files(dest_dir,
+                    xml_annots['yt_bb_detection_train'],
+                    xml_annots['yt_bb_detection_validation'],
+                    main_dir=main_dir)
+    if args.shard_count > 1:
+      with open(main_dir+'manifest.json','w') as f:
+        json.dump({'shard_index': args.shard_index,
+                   'shard_count': args.shard_count,
+                   'frames': dict((d_set, len(annots)) \
+                                  for d_set, annots in xml_annots.items())},
+                  f,indent=2,sort_keys=True)
+  finally:
+    # Stop the tuner and write the final metrics even when the run fails
+    if tuner is not None:
+      tuner.close()
+    youtube_bb.stats.close()
 
 if __name__ == '__main__':
 
-  assert(len(sys.argv) == 8), \
-    "Usage: python voc_convert.py [VID_SOURCE] [DSET_DEST] [NUM_THREADS] " \
-    "[NUM_TRAIN] [NUM_VAL] [MAX_RATIO] [INCL_ABS]"
-  src_dir          = sys.argv[1]+'/'
-  dest_dir         = sys.argv[2]+'/'
-  num_threads      = int(sys.argv[3])
-  num_train_frames = int(sys.argv[4])
-  num_val_frames   = int(sys.argv[5])
-  max_ratio        = float(sys.argv[6])
-  assert((sys.argv[7]=='0')or(sys.argv[7]=='1')), \
-    ["Please indicate if frames with absent objects should be included with",
-     "a 1, or should not be included with a 0"]
-  if sys.argv[6] == '1':
-    include_absent = True
-  else:
-    include_absent = False
-
-  # Download VOC 2007 devkit
-  devkit_link = \
-    "http://host.robots.ox.ac.uk/pascal/VOC/voc2007/VOCdevkit_08-Jun-2007.tar"
-  check_call(['wget','-P',dest_dir,devkit_link])
-
-  # Extract, rename, add missing directories
-  check_call(['tar','-xvf',
-              dest_dir+'VOCdevkit_08-Jun-2007.tar',
-              '-C',dest_dir])
-  check_call(['rm',dest_dir+'VOCdevkit_08-Jun-2007.tar'])
-  check_call(['mv',dest_dir+'VOCdevkit',dest_dir+'youtubebbdevkit2017'])
-  check_call(['mkdir','-p',
-              dest_dir+'youtubebbdevkit2017/youtubebb2017/ImageSets/Main'])
-  check_call(['mkdir','-p',
-              dest_dir+'youtubebbdevkit2017/youtubebb2017/JPEGImages'])
-  check_call(['mkdir','-p',
-              dest_dir+'youtubebbdevkit2017/youtubebb2017/Annotations'])
-  check_call(['mkdir','-p',
-              dest_dir+'youtubebbdevkit2017/results/youtubebb2017/Main'])
-
-  # Decode frames for training detection
-  train_frame_annots = decode_frames('yt_bb_detection_train',
-    src_dir,
-    dest_dir,
-    num_threads,
-    num_train_frames,
-    max_ratio,
-    include_absent)
-
-  # Write the xml annotations for training detection
-  train_xml_annots = write_xml_annots(dest_dir,train_frame_annots)
-
-  # Decode frames for validation detection
-  val_frame_annots = decode_frames('yt_bb_detection_validation',
-    src_dir,
-    dest_dir,
-    num_threads,
-    num_val_frames,
-    max_ratio,
-    include_absent)
-
-  # Write the xml annotations for validation detection
-  val_xml_annots = write_xml_annots(dest_dir,val_frame_annots)
-
-  # Write txt files
-  write_txt_files(dest_dir, train_xml_annots, val_xml_annots)
+  parser = argparse.ArgumentParser(description=description)
+  add_arguments(parser)
+  youtube_bb.add_positional_options(parser,positional_options)
+  main(youtube_bb.parse_positional_options(parser,positional_options))
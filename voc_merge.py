@@ -0,0 +1,48 @@
+########################################################################
+# YouTube BoundingBox VOC2007 Node Shard Merger
+########################################################################
+#
+# This script combines the outputs of a VOC2007 conversion which was
+# split across machines with the --shard-index and --shard-count
+# options of the converter. Each node shard writes its own ImageSets
+# files and a manifest into ImageSets/Main/node-INDEX-of-COUNT/. Once
+# every node shard is finished (and the node shard directories have
+# been gathered into one destination directory) this script
+# concatenates them into the usual ImageSets/Main files.
+#
+# The JPEG images, XML annotations and tar shards of each node shard
+# have distinct names, so they only need to be copied into place.
+#
+########################################################################
+
+import youtube_bb
+import voc_convert
+import argparse
+
+description = ('Merge the ImageSets files of a VOC 2007 conversion split '
+               'across node shards.')
+
+# The standalone script also takes the shard count positionally
+positional_options = [('shard_count',int)]
+
+# Add the command line arguments to `parser`
+def add_arguments(parser):
+  parser.add_argument('dest_dir', metavar='DSET_DEST',
+    help='The destination directory of the converted dataset')
+  parser.add_argument('--shard-count', type=int, default=None,
+    help='The number of node shards the conversion was split into')
+
+def main(args):
+  assert(args.shard_count is not None), \
+    "The shard count must be given with --shard-count"
+
+  num_frames = voc_convert.merge_imagesets(args.dest_dir+'/',args.shard_count)
+  for d_set in sorted(num_frames):
+    print(d_set+': '+str(num_frames[d_set])+' frames')
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(description=description)
+  add_arguments(parser)
+  youtube_bb.add_positional_options(parser,positional_options)
+  main(youtube_bb.parse_positional_options(parser,positional_options))
@@ -11,18 +11,23 @@
 ########################################################################
 
 from __future__ import unicode_literals
-from ffmpy import FFmpeg
 from subprocess import check_call
 from concurrent import futures
-from random import shuffle
+import random
 from datetime import datetime
+from itertools import islice
 import subprocess
-import youtube_dl
 import socket
+import threading
 import os
 import io
 import sys
+import queue
 import csv
+import json
+import shutil
+import zlib
+import time
 
 # Debug flag. Set this to true if you would like to see ffmpeg errors
 debug = False
@@ -66,6 +71,19 @@ class_list = [\
 # Host location of segment lists
 web_host = 'https://research.google.com/youtube-bb/'
 
+# Where the compressed annotation files ([D_SET].csv.gz) are read from: either
+# a base URL, such as web_host or a mirror on an internal file server, or a
+# local directory. Set with the YT_BB_ANNOTATIONS environment variable.
+annot_source = os.environ.get('YT_BB_ANNOTATIONS',web_host)
+
+# Where downloads which are kept between runs, such as the VOC devkit and the
+# source video cache, are kept. Set with the YT_BB_CACHE environment variable.
+cache_dir = os.environ.get('YT_BB_CACHE',
+                           os.path.expanduser('~/.cache/youtube_bb'))
+
+# The youtube-dl format of the downloaded source videos
+video_format = 'best[ext=mp4]'
+
 # Video clip class
 class video_clip(object):
   def __init__(self,
@@ -102,6 +120,205 @@ class video(object):
     for clip in self.clips:
       clip.print_all()
 
+# Columnar annotation store. Holds every row of an annotation csv file as
+# numpy arrays sorted by youtube id, class, object id and timestamp. The
+# youtube ids, class ids and object ids are stored as categorical codes whose
+# categories are sorted, so sorting by code matches sorting the strings.
+class annot_store(object):
+  # Bump this whenever the on-disk layout changes
+  version = 1
+  columns = ['yt','yt_cats','timestamp','cls','cls_cats','cls_names',
+             'obj','obj_cats','present','boxes']
+  def __init__(self,d_set,class_or_det,arrays):
+    self.d_set        = d_set
+    self.class_or_det = class_or_det
+    for name in self.columns:
+      setattr(self,name,arrays[name])
+    self._cats = None
+  def __len__(self):
+    return len(self.timestamp)
+  def _categories(self):
+    # Python lists of the categories, used when materializing rows
+    if self._cats is None:
+      self._cats = (self.yt_cats.tolist(),
+                    self.cls_cats.tolist(),
+                    self.cls_names.tolist(),
+                    self.obj_cats.tolist())
+    return self._cats
+  def __getitem__(self,idx):
+    # Materialize a row in the same form as the original csv row
+    if idx < 0:
+      idx += len(self)
+    yt_cats, cls_cats, cls_names, obj_cats = self._categories()
+    cls  = self.cls[idx]
+    presence = 'present' if self.present[idx] else 'absent'
+    row = [yt_cats[self.yt[idx]],
+           str(self.timestamp[idx]),
+           cls_cats[cls],
+           cls_names[cls]]
+    if self.class_or_det == 'class':
+      row.append(presence)
+    else:
+      row += [obj_cats[self.obj[idx]], presence]
+      row += [str(v) for v in self.boxes[idx]]
+    return row
+  def __iter__(self):
+    for idx in range(len(self)):
+      yield self[idx]
+
+  def save(self,path):
+    # Write each column to its own .npy file so that it can be memory mapped
+    # on load. The store is written to a temporary directory first and then
+    # moved into place so that readers never see a partial store.
+    import numpy as np
+    tmp_path = path+'.tmp'+str(os.getpid())
+    os.makedirs(tmp_path)
+    for name in self.columns:
+      np.save(tmp_path+'/'+name+'.npy', np.asarray(getattr(self,name)))
+    with open(tmp_path+'/meta.json','w') as f:
+      json.dump({'version':      self.version,
+                 'd_set':        self.d_set,
+                 'class_or_det': self.class_or_det,
+                 'source':       self.source}, f)
+    if os.path.exists(path):
+      shutil.rmtree(path)
+    os.rename(tmp_path,path)
+
+  @classmethod
+  def load(cls,path,source=None):
+    # Memory map a saved store. Returns None if there is no usable store, or
+    # if it was built from a different version of the source file.
+    import numpy as np
+    try:
+      with open(path+'/meta.json') as f:
+        meta = json.load(f)
+    except (IOError, ValueError):
+      return None
+    if (meta['version'] != cls.version) or \
+       ((source is not None) and (meta['source'] != source)):
+      return None
+    arrays = {}
+    for name in cls.columns:
+      arrays[name] = np.load(path+'/'+name+'.npy', mmap_mode='r')
+    store = cls(meta['d_set'],meta['class_or_det'],arrays)
+    store.source = meta['source']
+    return store
+
+  @classmethod
+  def from_csv(cls,d_set,f,chunk_size=1<<20):
+    # Build a store from the rows of an annotation csv file, parsing it in
+    # chunks so that only one chunk of python strings is alive at a time
+    import numpy as np
+    if ('classification' in d_set):
+      class_or_det = 'class'
+    elif ('detection' in d_set):
+      class_or_det = 'det'
+    codes  = {'yt': {}, 'cls': {}, 'obj': {}}
+    names  = {}
+    chunks = []
+    reader = csv.reader(f)
+    while True:
+      rows = list(islice(reader,chunk_size))
+      if not rows:
+        break
+      cols  = list(zip(*rows))
+      del rows
+      chunk = {}
+      chunk['timestamp'] = np.array(cols[1]).astype(np.int64)
+      chunk['yt']  = _encode(codes['yt'], cols[0])
+      chunk['cls'] = _encode(codes['cls'],cols[2])
+      for class_id, class_name in zip(cols[2],cols[3]):
+        names.setdefault(class_id,class_name)
+      if class_or_det == 'class':
+        chunk['obj']     = _encode(codes['obj'],('0',)*len(cols[0]))
+        chunk['present'] = (np.array(cols[4]) == 'present')
+        chunk['boxes']   = np.zeros((len(cols[0]),0),dtype=np.float32)
+      else:
+        chunk['obj']     = _encode(codes['obj'],cols[4])
+        chunk['present'] = (np.array(cols[5]) == 'present')
+        chunk['boxes']   = np.array(cols[6:10]).astype(np.float32).T
+      chunks.append(chunk)
+      del cols
+
+    arrays = {}
+    for name in ['timestamp','yt','cls','obj','present','boxes']:
+      arrays[name] = np.concatenate([chunk[name] for chunk in chunks])
+    del chunks
+
+    # Renumber the codes so that the categories are in sorted order
+    for name in ['yt','cls','obj']:
+      cats, remap = _sorted_categories(codes[name])
+      arrays[name] = remap[arrays[name]]
+      arrays[name+'_cats'] = cats
+    arrays['cls_names'] = np.array([names[c] for c in arrays['cls_cats']])
+
+    # Sort to de-interleave the annotations for easier parsing. For
+    # classification data sets the object id is always '0', so this sorts by
+    # youtube_id, class, and then timestamp.
+    order = np.lexsort((arrays['timestamp'],
+                        arrays['obj'],
+                        arrays['cls'],
+                        arrays['yt']))
+    for name in ['timestamp','yt','cls','obj','present','boxes']:
+      arrays[name] = arrays[name][order]
+    return cls(d_set,class_or_det,arrays)
+
+# Map a sequence of strings to integer codes, adding new strings to `codes`
+def _encode(codes,values):
+  import numpy as np
+  uniques, inverse = np.unique(np.array(values),return_inverse=True)
+  lookup = np.array([codes.setdefault(u,len(codes)) for u in uniques.tolist()],
+                    dtype=np.int32)
+  return lookup[inverse.reshape(-1)]
+
+# Sort the categories of a code dictionary. Returns the sorted categories and
+# an array mapping the old codes to the new ones.
+def _sorted_categories(codes):
+  import numpy as np
+  cats = sorted(codes)
+  remap = np.empty(len(cats),dtype=np.int32)
+  for new_code, cat in enumerate(cats):
+    remap[codes[cat]] = new_code
+  return np.array(cats), remap
+
+# Clip index class. Maps clip names to clips and to the sorted timestamps
+# (in ms) of every annotation within that clip. `bounds` holds the first and
+# one past the last row of each clip within the annotation store.
+class clip_index(object):
+  def __init__(self,store,clips,bounds):
+    self.store  = store
+    self.clips  = clips
+    self.bounds = bounds
+    self.ids    = dict((clip.name, idx) for idx, clip in enumerate(clips))
+  def __contains__(self,clip_name):
+    return clip_name in self.ids
+  def __len__(self):
+    return len(self.clips)
+  def get(self,clip_name):
+    idx = self.ids.get(clip_name)
+    if idx is None:
+      return None
+    return self.clips[idx]
+  def timestamps(self,clip_name):
+    lo, hi = self.bounds[self.ids[clip_name]]
+    return self.store.timestamp[lo:hi]
+  def is_boundary(self,clip_name,timestamp):
+    # True if the timestamp is the first or last annotation of the clip
+    times = self.timestamps(clip_name)
+    return (int(timestamp) == times[0]) or (int(timestamp) == times[-1])
+  def row_clips(self):
+    # The index of the clip that each annotation row belongs to
+    import numpy as np
+    return np.repeat(np.arange(len(self.clips)),
+                     self.bounds[:,1]-self.bounds[:,0])
+  def boundary_rows(self):
+    # Mask of the annotation rows that are the first or last of their clip
+    row_clips = self.row_clips()
+    first = self.store.timestamp[self.bounds[:,0]]
+    last  = self.store.timestamp[self.bounds[:,1]-1]
+    return (self.store.timestamp == first[row_clips]) | \
+           (self.store.timestamp == last[row_clips])
+
 # XML detection annotation class
 class xml_annot(object):
   def __init__(self,
@@ -138,170 +355,2093 @@ class xml_annot(object):
     self.ymax           = str(ymax)
 
 
-# Download and cut a clip to size
-def dl_and_cut(vid):
+# Writes samples into a sequence of tar shards of a fixed maximum size, in the
+# WebDataset layout: all files of a sample are stored next to each other and
+# share the sample's key as their base name, e.g. `key.jpg` and `key.xml`.
+# Alongside each `prefix-000000.tar` shard is a `prefix-000000.idx` index
+# with one tab separated line per file (key, extension, data offset and size)
+# so that any single file can be read with one seek. add() may be called from
+# several threads at once.
+class shard_writer(object):
+  def __init__(self,shard_dir,prefix='shard',max_shard_size=1<<30):
+    self.shard_dir      = shard_dir
+    self.prefix         = prefix
+    self.max_shard_size = max_shard_size
+    self.num_shards     = 0
+    self.num_samples    = 0
+    self.tar            = None
+    self.index          = None
+    self.lock           = threading.Lock()
+    os.makedirs(shard_dir, exist_ok=True)
+
+  def _next_shard(self):
+    import tarfile
+    self._close_shard()
+    shard_name = self.shard_dir+'/'+self.prefix+'-%06d' % self.num_shards
+    self.tar   = tarfile.open(shard_name+'.tar','w',format=tarfile.USTAR_FORMAT)
+    self.index = open(shard_name+'.idx','w')
+    self.num_shards += 1
+
+  def _close_shard(self):
+    if self.tar is not None:
+      self.tar.close()
+      self.index.close()
+      self.tar   = None
+      self.index = None
+
+  def add(self,key,files):
+    # Add a sample made up of `files`, a dictionary mapping each file
+    # extension to the file's contents as bytes
+    import tarfile
+    with self.lock:
+      size = sum(len(data) for data in files.values())
+      if (self.tar is None) or \
+         ((self.tar.offset > 0) and \
+          (self.tar.offset+size > self.max_shard_size)):
+        self._next_shard()
+      for ext in sorted(files):
+        data = files[ext]
+        info = tarfile.TarInfo(key+'.'+ext)
+        info.size  = len(data)
+        info.mtime = time.time()
+        self.tar.addfile(info,io.BytesIO(data))
+        # The data ends at the current offset, less the padding to a whole
+        # number of tar blocks
+        blocks = (len(data)+tarfile.BLOCKSIZE-1)//tarfile.BLOCKSIZE
+        offset = self.tar.offset-blocks*tarfile.BLOCKSIZE
+        self.index.write('\t'.join([key,ext,str(offset),str(len(data))])+'\n')
+      self.num_samples += 1
+
+  def close(self):
+    with self.lock:
+      self._close_shard()
+
+# Random access reader for the shards written by shard_writer. Loads the
+# index of every shard in `shard_dir` whose name starts with `prefix`.
+class shard_reader(object):
+  def __init__(self,shard_dir,prefix='shard'):
+    self.files = {}
+    for idx_name in sorted(os.listdir(shard_dir)):
+      if not (idx_name.startswith(prefix+'-') and idx_name.endswith('.idx')):
+        continue
+      tar_path = shard_dir+'/'+idx_name[:-4]+'.tar'
+      with open(shard_dir+'/'+idx_name) as f:
+        for line in f:
+          key, ext, offset, size = line.rstrip('\n').split('\t')
+          self.files.setdefault(key,{})[ext] = (tar_path,int(offset),int(size))
+  def keys(self):
+    return self.files.keys()
+  def read(self,key,ext):
+    # Read one file of a sample straight out of its shard
+    tar_path, offset, size = self.files[key][ext]
+    with open(tar_path,'rb') as f:
+      f.seek(offset)
+      return f.read(size)
+
+# Upper bounds (in seconds) of the buckets of the timing histograms
+metrics_buckets = [0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,120,
+                   300,600,1800]
+
+# Counters, gauges and histograms describing a run, shared by all scripts
+# through the module level `stats`. Nothing is written unless start() is
+# called, after which a background thread writes every metric to `path`
+# every `interval` seconds: as a Prometheus text file (for the node exporter
+# textfile collector) if the path ends in '.prom', and appended as one JSON
+# object per line otherwise. Tasks registered with set_total() also report
+# their progress, throughput and estimated time remaining. Throughput is
+# measured over the last `window` seconds so that the estimate follows the
+# recent rate rather than the average of the whole run.
+class metrics(object):
+  def __init__(self,prefix='yt_bb_'):
+    self.prefix     = prefix
+    self.lock       = threading.Lock()
+    self.counters   = {}
+    self.gauges     = {}
+    self.histograms = {}
+    self.totals     = {}
+    self.history    = {}
+    self.started    = time.time()
+    self.path       = None
+    self.stopped    = threading.Event()
+    self.thread     = None
+
+  def inc(self,name,value=1,**labels):
+    key = (name,tuple(sorted(labels.items())))
+    with self.lock:
+      self.counters[key] = self.counters.get(key,0)+value
+
+  def set(self,name,value,**labels):
+    key = (name,tuple(sorted(labels.items())))
+    with self.lock:
+      self.gauges[key] = value
+
+  def observe(self,name,value,count=1,**labels):
+    # Record `count` samples of `value`
+    key = (name,tuple(sorted(labels.items())))
+    with self.lock:
+      hist = self.histograms.get(key)
+      if hist is None:
+        hist = self.histograms[key] = [[0]*len(metrics_buckets),0,0.0]
+      for i, bound in enumerate(metrics_buckets):
+        if value <= bound:
+          hist[0][i] += count
+      hist[1] += count
+      hist[2] += value*count
+
+  def set_total(self,task,total):
+    # Register the total amount of work of a task whose progress is counted
+    # by the counter `task`
+    with self.lock:
+      self.totals[task] = self.totals.get(task,0)+total
+
+  def start(self,path,interval=30,window=300):
+    self.path     = path
+    self.interval = interval
+    self.window   = window
+    self.thread   = threading.Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def close(self):
+    # Stop the writer thread and write the final values
+    if self.thread is None:
+      return
+    self.stopped.set()
+    self.thread.join()
+    self.thread = None
+    self.write()
+
+  def _run(self):
+    while not self.stopped.wait(self.interval):
+      try:
+        self.write()
+      except Exception as exc:
+        print('writing metrics failed', exc)
+
+  def progress(self):
+    # Progress of every task with a total: done, rate and time remaining
+    now = time.time()
+    tasks = {}
+    with self.lock:
+      for task, total in self.totals.items():
+        done = sum(value for (name, labels), value in self.counters.items() \
+                   if name == task)
+        history = self.history.setdefault(task,[(self.started,0)])
+        history.append((now,done))
+        # Keep one sample older than the window to measure the rate over it
+        while (len(history) > 2) and (history[1][0] <= now-self.window):
+          history.pop(0)
+        then, done_then = history[0]
+        rate = (done-done_then)/(now-then) if now > then else 0.0
+        eta  = (total-done)/rate if rate > 0 else None
+        tasks[task] = {'done': done, 'total': total, 'rate': rate, 'eta': eta}
+    return tasks
+
+  def write(self):
+    if self.path is None:
+      return
+    tasks = self.progress()
+    with self.lock:
+      counters   = dict(self.counters)
+      gauges     = dict(self.gauges)
+      histograms = dict((key, [list(hist[0]),hist[1],hist[2]]) \
+                        for key, hist in self.histograms.items())
+    gauges[('elapsed_seconds',())] = time.time()-self.started
+    for task, prog in tasks.items():
+      labels = (('task',task),)
+      gauges[('progress_done',labels)]  = prog['done']
+      gauges[('progress_total',labels)] = prog['total']
+      gauges[('progress_rate',labels)]  = prog['rate']
+      if prog['eta'] is not None:
+        gauges[('eta_seconds',labels)]  = prog['eta']
+    if self.path.endswith('.prom'):
+      text = self._prometheus(counters,gauges,histograms)
+      # Replace the file atomically so that it is never read half written
+      with open(self.path+'.tmp','w') as f:
+        f.write(text)
+      os.replace(self.path+'.tmp',self.path)
+    else:
+      record = {'time':       time.time(),
+                'counters':   dict((self._name(key), value) \
+                                   for key, value in counters.items()),
+                'gauges':     dict((self._name(key), value) \
+                                   for key, value in gauges.items()),
+                'histograms': dict((self._name(key), \
+                                    {'count': hist[1],
+                                     'sum':   hist[2],
+                                     'mean':  hist[2]/hist[1] if hist[1] \
+                                              else None}) \
+                                   for key, hist in histograms.items()),
+                'progress':   tasks}
+      with open(self.path,'a') as f:
+        f.write(json.dumps(record,sort_keys=True)+'\n')
+
+  def _name(self,key,extra=()):
+    name, labels = key
+    labels = labels+extra
+    if not labels:
+      return self.prefix+name
+    return self.prefix+name+'{'+','.join( \
+      k+'="'+str(v).replace('\\','\\\\').replace('"','\\"')+'"' \
+      for k, v in labels)+'}'
+
+  def _prometheus(self,counters,gauges,histograms):
+    lines = []
+    for kind, values in [('counter',counters),('gauge',gauges)]:
+      typed = set()
+      for key in sorted(values):
+        if key[0] not in typed:
+          typed.add(key[0])
+          lines.append('# TYPE '+self.prefix+key[0]+' '+kind)
+        lines.append(self._name(key)+' '+repr(float(values[key])))
+    typed = set()
+    for key in sorted(histograms):
+      buckets, count, total = histograms[key]
+      if key[0] not in typed:
+        typed.add(key[0])
+        lines.append('# TYPE '+self.prefix+key[0]+' histogram')
+      name, labels = key
+      for bound, bucket in zip(metrics_buckets,buckets):
+        lines.append(self._name((name+'_bucket',labels),(('le',repr(bound)),))+
+                     ' '+str(bucket))
+      lines.append(self._name((name+'_bucket',labels),(('le','+Inf'),))+
+                   ' '+str(count))
+      lines.append(self._name((name+'_sum',labels))+' '+repr(total))
+      lines.append(self._name((name+'_count',labels))+' '+str(count))
+    return '\n'.join(lines)+'\n'
+
+# Metrics of this run
+stats = metrics()
+
+# Read the cumulative busy, I/O wait and total CPU times of the machine from
+# /proc/stat. Returns None where /proc/stat is not available.
+def cpu_times():
+  try:
+    with open('/proc/stat') as f:
+      fields = [float(x) for x in f.readline().split()[1:]]
+  except (IOError, OSError, ValueError):
+    return None
+  # user nice system idle iowait irq softirq steal
+  idle, iowait = fields[3], fields[4]
+  total = sum(fields[:8])
+  return total-idle-iowait, iowait, total
+
+# Tunes the number of concurrent ffmpeg jobs, and the number of threads each
+# ffmpeg uses, while a run is going. Jobs are run through run(), which
+# admits at most `jobs` of them at once and passes the current ffmpeg thread
+# count to each as `threads`. Every `interval` seconds the CPU utilization,
+# I/O wait and throughput (the `work` of the finished jobs) are sampled:
+#   - High I/O wait means the disks are the bottleneck, so a job is removed.
+#   - Idle CPUs are given more work: another job if every job slot is in
+#     use, otherwise (towards the end of a run, when there are fewer jobs
+#     than slots) more threads for each ffmpeg.
+#   - A change which lowered the throughput is undone, and further increases
+#     are held off for a few intervals.
+# The counts stay within [min_jobs, max_jobs] and [1, max_ffmpeg_threads].
+# Every change is logged along with the measurements that led to it.
+class autotuner(object):
+  def __init__(self,
+               jobs,
+               max_jobs,
+               ffmpeg_threads=1,
+               max_ffmpeg_threads=4,
+               min_jobs=1,
+               interval=10,
+               target_util=0.9,
+               max_iowait=0.2):
+    self.jobs               = min(max(jobs,min_jobs),max_jobs)
+    self.min_jobs           = min_jobs
+    self.max_jobs           = max_jobs
+    self.ffmpeg_threads     = min(max(ffmpeg_threads,1),max_ffmpeg_threads)
+    self.max_ffmpeg_threads = max_ffmpeg_threads
+    self.interval           = interval
+    self.target_util        = target_util
+    self.max_iowait         = max_iowait
+    self.running            = 0
+    self.work               = 0.0
+    self.last_change        = None
+    self.last_rate          = None
+    self.hold               = 0
+    self.cond               = threading.Condition()
+    self.stopped            = threading.Event()
+    self.thread             = None
+    self._record()
+
+  def run(self,func,*args,**kwargs):
+    # Run func(*args, threads=N) once a job slot is free. `work` is the
+    # amount of work done by the job, used to measure throughput.
+    work = kwargs.pop('work',1)
+    with self.cond:
+      while self.running >= self.jobs:
+        self.cond.wait()
+      self.running += 1
+      threads = self.ffmpeg_threads
+    try:
+      return func(*args,threads=threads,**kwargs)
+    finally:
+      with self.cond:
+        self.running -= 1
+        self.work    += work
+        self.cond.notify_all()
+
+  def start(self):
+    self.sample_cpu  = cpu_times()
+    self.sample_time = time.time()
+    self.thread = threading.Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def close(self):
+    if self.thread is not None:
+      self.stopped.set()
+      self.thread.join()
+      self.thread = None
 
-  d_set_dir = vid.clips[0].d_set_dir
+  def _run(self):
+    while not self.stopped.wait(self.interval):
+      try:
+        self._tune()
+      except Exception as exc:
+        print('autotune failed', exc)
+
+  def _record(self):
+    stats.set('autotune_jobs',self.jobs)
+    stats.set('autotune_ffmpeg_threads',self.ffmpeg_threads)
+
+  def _tune(self):
+    now  = time.time()
+    cpu  = cpu_times()
+    util = 0.0
+    wait = 0.0
+    if (cpu is not None) and (self.sample_cpu is not None) and \
+       (cpu[2] > self.sample_cpu[2]):
+      total = cpu[2]-self.sample_cpu[2]
+      util  = (cpu[0]-self.sample_cpu[0])/total
+      wait  = (cpu[1]-self.sample_cpu[1])/total
+    elif hasattr(os,'getloadavg'):
+      util  = os.getloadavg()[0]/(os.cpu_count() or 1)
+    with self.cond:
+      rate      = self.work/max(now-self.sample_time,1e-6)
+      running   = self.running
+      self.work = 0.0
+    self.sample_cpu  = cpu
+    self.sample_time = now
+
+    jobs, threads = self.jobs, self.ffmpeg_threads
+    reason   = None
+    reverted = (self.last_change is not None) and \
+               (self.last_rate is not None) and (rate < 0.95*self.last_rate)
+    if reverted:
+      # The last change made things worse
+      jobs, threads = self.last_change
+      reason = 'throughput fell'
+    elif (wait > self.max_iowait) and (jobs > self.min_jobs):
+      jobs  -= 1
+      reason = 'I/O wait'
+    elif self.hold > 0:
+      self.hold -= 1
+    elif util < self.target_util:
+      if (running >= jobs) and (jobs < self.max_jobs):
+        jobs   += 1
+        reason  = 'idle CPUs'
+      elif (running < jobs) and (threads < self.max_ffmpeg_threads):
+        threads += 1
+        reason   = 'idle CPUs, fewer jobs than slots'
+
+    if (jobs, threads) != (self.jobs, self.ffmpeg_threads):
+      print('autotune: jobs {} -> {}, ffmpeg threads {} -> {} ({}: CPU {:.0f}%, '
+            'I/O wait {:.0f}%, {:.2f} work/s)'.format( \
+              self.jobs, jobs, self.ffmpeg_threads, threads, reason,
+              100*util, 100*wait, rate))
+      self.last_change = None if reverted else \
+                         (self.jobs, self.ffmpeg_threads)
+      if reverted:
+        self.hold = 3
+      with self.cond:
+        self.jobs           = jobs
+        self.ffmpeg_threads = threads
+        self.cond.notify_all()
+      self._record()
+    else:
+      self.last_change = None
+    self.last_rate = rate
+
+# Maximum number of outputs (frames or clips) to write with a single ffmpeg
+# invocation. This keeps the command line to a reasonable length for very long
+# clips and for videos with many clips.
+max_ffmpeg_outputs = 64
+
+# The ways clips can be cut out of a downloaded video:
+#   'multi'    - Decode the video once and re-encode every clip as one output
+#                of a single ffmpeg run. Frame accurate.
+#   'per_clip' - Re-encode each clip with its own ffmpeg run, decoding the
+#                video again for every clip. Frame accurate.
+#   'copy'     - Stream copy each clip without re-encoding. ffmpeg starts each
+#                clip at the keyframe preceding the clip start and marks the
+#                extra frames with an edit list, so the data is GOP aligned.
+#                Much cheaper, but players that ignore edit lists will show
+#                up to one GOP of extra frames at the start of each clip.
+cut_modes = ['multi','per_clip','copy']
+
+# Run an ffmpeg command, hiding its output unless debugging
+def run_ffmpeg(args):
+  if debug:
+    check_call(args)
+  else:
+    FNULL = open(os.devnull, 'w')
+    check_call(args, stdout=FNULL, stderr=subprocess.STDOUT)
+
+# Extract the frames at each of `decode_times` (in ms, relative to the start
+# of the clip) into `frame_paths`. All frames of the clip are extracted with
+# a single ffmpeg invocation: every frame is its own output with its own
+# output seek, so the clip is only opened, demuxed and decoded once. ffmpeg
+# uses `threads` threads. Existing frames, such as those of an interrupted
+# run, are overwritten.
+def decode_clip_frames(clip_path,decode_times,frame_paths,threads=1):
+  start = time.time()
+  for lo in range(0,len(frame_paths),max_ffmpeg_outputs):
+    hi = lo+max_ffmpeg_outputs
+    args = ['ffmpeg', '-y', '-i', clip_path]
+    for decode_time, frame_path in zip(decode_times[lo:hi],frame_paths[lo:hi]):
+      args += ['-ss', str(float(decode_time)/1000.0),\
+               '-qscale:v','2',\
+               '-vframes','1',\
+               '-threads',str(threads),\
+               frame_path]
+    run_ffmpeg(args)
+  if frame_paths:
+    stats.observe('decode_frame_seconds',
+                  (time.time()-start)/len(frame_paths),len(frame_paths))
+
+# Read the dimensions, frame rate, duration and codec of the first video
+# stream of a clip with ffprobe
+def probe_clip(clip_path):
+  out = subprocess.check_output(['ffprobe',
+    '-v','error',
+    '-select_streams','v:0',
+    '-show_entries','stream=width,height,avg_frame_rate,codec_name:'
+                    'format=duration',
+    '-of','json',
+    clip_path])
+  info   = json.loads(out.decode('utf-8'))
+  if not info.get('streams'):
+    raise ValueError(clip_path+': no video stream')
+  stream = info['streams'][0]
+  num, _, den = stream.get('avg_frame_rate','0/1').partition('/')
+  return {'width':    int(stream['width']),
+          'height':   int(stream['height']),
+          'fps':      float(num)/float(den or 1) if float(den or 1) else 0.0,
+          'duration': float(info.get('format',{}).get('duration',0.0)),
+          'codec':    stream.get('codec_name','')}
+
+# Persistent cache of probe_clip results. Entries are keyed by clip path and
+# are probed again if the clip's size or modification time changes. The cache
+# is kept in memory and written to the JSON file at `path` by save().
+class probe_cache(object):
+  def __init__(self,path=None):
+    self.path    = path
+    self.entries = {}
+    self.dirty   = False
+    self.lock    = threading.Lock()
+    if (path is not None) and os.path.exists(path):
+      try:
+        with open(path) as f:
+          self.entries = json.load(f)
+      except ValueError:
+        self.entries = {}
+
+  def get(self,clip_path):
+    # The probe information of a clip, probing it if it isn't cached
+    clip_path = os.path.normpath(clip_path)
+    stat = os.stat(clip_path)
+    key  = [stat.st_size, int(stat.st_mtime)]
+    with self.lock:
+      entry = self.entries.get(clip_path)
+    if (entry is not None) and (entry['key'] == key):
+      return entry['info']
+    info = probe_clip(clip_path)
+    with self.lock:
+      self.entries[clip_path] = {'key': key, 'info': info}
+      self.dirty = True
+    return info
+
+  def save(self):
+    # Write the cache to disk, atomically replacing the previous file
+    with self.lock:
+      if (self.path is None) or not self.dirty:
+        return
+      tmp_path = self.path+'.tmp'+str(os.getpid())
+      with open(tmp_path,'w') as f:
+        json.dump(self.entries,f)
+      os.replace(tmp_path,self.path)
+      self.dirty = False
+
+# The probe cache of a data set's clips, kept in the data set directory
+def load_probes(dl_dir,d_set):
+  return probe_cache(dl_dir+'/'+d_set+'/probes.json')
+
+# True if the frames described by probe information are within the maximum
+# aspect ratio. A maximum of 0 allows every aspect ratio.
+def aspect_ok(info,max_ratio):
+  width, height = info['width'], info['height']
+  return (max_ratio == 0) or \
+         not ( ((width/height) > max_ratio) or
+               ((height/width) > max_ratio) )
+
+# Run `func` in `executor` on the arguments of each `(key, args)` pair of
+# `tasks`, keeping at most `window` tasks submitted and unfinished. The
+# number of futures and task arguments held at once therefore stays the same
+# however many tasks there are, and `tasks` may be a generator, which is only
+# advanced as tasks finish. Yields the key and the future of each task as it
+# finishes. The decoders submit their clips this way, and with an autotuner
+# `func` runs each clip through autotuner.run in an executor of the tuner's
+# max_jobs threads, so that the tuner rather than the executor sets how many
+# clips are decoded at once and how many threads each ffmpeg uses.
+def bounded_submit(executor,func,tasks,window):
+  tasks   = iter(tasks)
+  pending = {}
+  while True:
+    for key, args in tasks:
+      pending[executor.submit(func,*args)] = key
+      if len(pending) >= window:
+        break
+    if not pending:
+      return
+    done, _ = futures.wait(pending,return_when=futures.FIRST_COMPLETED)
+    for f in done:
+      yield pending.pop(f), f
+
+# Drop the rows of clips whose frames exceed the maximum aspect ratio from a
+# frame mask, probing the clips in parallel through `probes`. Clips which
+# can't be probed are dropped too. Returns the updated mask.
+def filter_aspect(keep,clips,clip_idx,probes,max_ratio,num_threads=4):
+  import numpy as np
+  if max_ratio == 0:
+    return keep
+  row_clips = clip_idx.row_clips()
+  clip_ids  = np.unique(row_clips[keep])
+  clip_ok = np.ones(len(clips),dtype=bool)
+  with futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+    for clip_id, f in bounded_submit(executor,probes.get,
+        ((clip_id, (clip_path(clips[clip_id]),)) \
+         for clip_id in clip_ids.tolist()),
+        2*num_threads):
+      # Check for an exception in the workers.
+      try:
+        clip_ok[clip_id] = aspect_ok(f.result(),max_ratio)
+      except Exception as exc:
+        print('probe failed', exc)
+        stats.inc('failures_total',stage='probe',cause=type(exc).__name__)
+        clip_ok[clip_id] = False
+  probes.save()
+  return keep & clip_ok[row_clips]
+
+# Decode the frames at each of `decode_times` (in ms, relative to the start of
+# the clip) straight into memory. Returns one height x width x 3 RGB uint8
+# array of its own per decode time, or None for times past the end of the clip. The clip
+# is decoded once: a select filter passes on the first frame at or after each
+# time, so the frames are the same ones that decode_clip_frames extracts. If
+# `size` is given as (width, height) the frames are scaled by ffmpeg,
+# otherwise the clip's dimensions are probed, through `probes` if given.
+def decode_clip_raw(clip_path,decode_times,size=None,probes=None):
+  import numpy as np
+  if size is None:
+    info = probe_clip(clip_path) if probes is None else probes.get(clip_path)
+    size = (info['width'], info['height'])
+  width, height = size
+  frame_bytes   = width*height*3
+  decode_secs   = [float(t)/1000.0 for t in decode_times]
+  frames        = [None]*len(decode_secs)
+  order         = sorted(range(len(decode_secs)), key=lambda i: decode_secs[i])
+  start         = time.time()
+
+  for lo in range(0,len(order),max_ffmpeg_outputs):
+    chunk = order[lo:lo+max_ffmpeg_outputs]
+    # Select a frame if any decode time falls between it and the frame before
+    crossed = ['gte(t,{0})*(isnan(prev_t)+lt(prev_t,{0}))'.format( \
+                 repr(decode_secs[i])) for i in chunk]
+    filters = "select='"+'+'.join(crossed)+"',showinfo," + \
+              'scale='+str(width)+':'+str(height)
+    proc = subprocess.Popen(['ffmpeg',
+      '-i', clip_path,
+      '-vf', filters,
+      '-vsync','0',
+      '-threads','1',
+      '-f','rawvideo',
+      '-pix_fmt','rgb24',
+      'pipe:1'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+      raise subprocess.CalledProcessError(proc.returncode,'ffmpeg',err)
+
+    # Match each decode time to the first selected frame at or after it,
+    # using the frame times reported by the showinfo filter
+    frame_times = [float(line.split('pts_time:')[1].split()[0]) \
+                   for line in err.decode('utf-8','replace').splitlines() \
+                   if ('] n:' in line) and ('pts_time:' in line)]
+    num_frames  = min(len(frame_times), len(out)//frame_bytes)
+    decoded = np.frombuffer(out, dtype=np.uint8, count=num_frames*frame_bytes)
+    decoded = decoded.reshape((num_frames,height,width,3))
+    frame = 0
+    for i in chunk:
+      while (frame < num_frames) and (frame_times[frame] < decode_secs[i]):
+        frame += 1
+      if frame < num_frames:
+        # Copy the frame so that it doesn't keep the output of the whole
+        # ffmpeg run alive
+        frames[i] = decoded[frame].copy()
+  if frames:
+    stats.observe('decode_frame_seconds',
+                  (time.time()-start)/len(frames),len(frames))
+  return frames
+
+# Fragments of youtube-dl error messages which mean that the video can not
+# be downloaded at all, rather than that the download failed this time
+unavailable_errors = [
+  'video unavailable',
+  'this video is unavailable',
+  'this video is not available',
+  'private video',
+  'has been removed',
+  'account associated with this video has been terminated',
+  'copyright',
+  'not available in your country',
+  'sign in to confirm your age',
+  ]
+
+# Error raised when a video could not be downloaded. `unavailable` is set if
+# the video is gone from YouTube and retrying is pointless.
+class download_error(Exception):
+  def __init__(self,yt_id,reason,unavailable=False):
+    Exception.__init__(self,yt_id+': '+reason)
+    self.reason      = reason
+    self.unavailable = unavailable
+
+# Download a video into its data set directory with youtube-dl. Returns the
+# path of the downloaded video.
+def download_video(vid):
+  src_path = vid.clips[0].d_set_dir+'/'+vid.yt_id+'_temp.mp4'
 
   # Use youtube_dl to download the video
-  FNULL = open(os.devnull, 'w')
-  check_call(['youtube-dl', \
+  proc = subprocess.Popen(['youtube-dl', \
     #'--no-progress', \
-    '-f','best[ext=mp4]', \
-    '-o',d_set_dir+'/'+vid.yt_id+'_temp.mp4', \
+    '-f',video_format, \
+    '-o',src_path, \
     'youtu.be/'+vid.yt_id ], \
-     stdout=FNULL,stderr=subprocess.STDOUT )
+     stdout=subprocess.DEVNULL,stderr=subprocess.PIPE )
+  _, err = proc.communicate()
+  if proc.returncode != 0:
+    # Use the last error youtube-dl reported as the reason
+    errors = [line for line in err.decode('utf-8','replace').splitlines() \
+              if line.startswith('ERROR')]
+    reason = errors[-1] if errors else \
+      'youtube-dl exited with status '+str(proc.returncode)
+    raise download_error(vid.yt_id, reason,
+      any(e in reason.lower() for e in unavailable_errors))
+  # Verify that the video has been downloaded
+  if not os.path.exists(src_path):
+    raise download_error(vid.yt_id, 'youtube-dl did not write the video')
+  return src_path
+
+# Stand in for download_video which takes the source videos from a local
+# directory, where they are named `yt_id.mp4`, instead of downloading them
+class local_sources(object):
+  def __init__(self,source_dir):
+    self.source_dir = source_dir
+
+  def __call__(self,vid):
+    src_path = vid.clips[0].d_set_dir+'/'+vid.yt_id+'_temp.mp4'
+    source   = self.source_dir+'/'+vid.yt_id+'.mp4'
+    if not os.path.exists(source):
+      raise download_error(vid.yt_id, 'no source video in '+self.source_dir,
+                           True)
+    # The temporary video is removed once cut, so link or copy the source
+    link_or_copy(source,src_path)
+    return src_path
+
+# Cache of downloaded source videos, keyed by youtube id and format, which
+# stands in for the fetch function `fetch`. Videos found in the cache are
+# linked into place instead of being downloaded again, and downloaded videos
+# are added to it before they are cut. Entries are written under a temporary
+# name and renamed into place, so that other threads and processes never see
+# a partial video. Once the cache grows past `max_size` bytes the least
+# recently used videos are evicted. hit() tells whether the last video the
+# calling thread fetched was found in the cache.
+class source_cache(object):
+  def __init__(self,
+               cache_dir,
+               max_size,
+               fetch=download_video,
+               format=None):
+    self.cache_dir = cache_dir
+    self.max_size  = max_size
+    self.fetch     = fetch
+    self.key       = '{:08x}'.format(zlib.crc32( \
+      (format or video_format).encode('utf-8')))
+    self.lock      = threading.Lock()
+    self.last      = threading.local()
+    os.makedirs(cache_dir, exist_ok=True)
+
+  def path(self,vid):
+    return self.cache_dir+'/'+vid.yt_id+'.'+self.key+'.mp4'
+
+  def __call__(self,vid):
+    src_path   = vid.clips[0].d_set_dir+'/'+vid.yt_id+'_temp.mp4'
+    cache_path = self.path(vid)
+    self.last.hit = False
+    try:
+      link_or_copy(cache_path,src_path)
+    except (IOError, OSError):
+      # Not cached, or evicted since
+      stats.inc('source_cache_total',result='miss')
+      src_path = self.fetch(vid)
+      self.add(cache_path,src_path)
+    else:
+      # The modification time records when an entry was last used
+      os.utime(cache_path)
+      stats.inc('source_cache_total',result='hit')
+      self.last.hit = True
+    return src_path
+
+  def hit(self):
+    return getattr(self.last,'hit',False)
+
+  def add(self,cache_path,src_path):
+    tmp_path = cache_path+'.'+str(os.getpid())+'.'+ \
+               str(threading.get_ident())+'.tmp'
+    link_or_copy(src_path,tmp_path)
+    os.replace(tmp_path,cache_path)
+    self.evict(cache_path)
 
+  def evict(self,keep=None):
+    with self.lock:
+      entries = []
+      for name in os.listdir(self.cache_dir):
+        path = self.cache_dir+'/'+name
+        if name.endswith('.mp4') and path != keep:
+          try:
+            stat = os.stat(path)
+          except OSError:
+            continue
+          entries.append((stat.st_mtime, stat.st_size, path))
+      size = sum(entry[1] for entry in entries)
+      if keep is not None and os.path.exists(keep):
+        size += os.path.getsize(keep)
+      for _, entry_size, path in sorted(entries):
+        if size <= self.max_size:
+          break
+        # Readers link the video before using it, so removing it is safe
+        try:
+          os.remove(path)
+        except OSError:
+          pass
+        size -= entry_size
+        stats.inc('source_cache_evictions_total')
+
+# Hard link `src` to `dst`, or copy it if it's on another file system
+def link_or_copy(src,dst):
+  try:
+    os.link(src,dst)
+  except FileExistsError:
+    os.remove(dst)
+    os.link(src,dst)
+  except OSError:
+    if not os.path.exists(src):
+      raise
+    shutil.copyfile(src,dst)
+
+# Path of a clip within its data set directory
+def clip_path(clip):
+  return clip.d_set_dir+'/'+str(clip.class_id)+'/'+clip.name+'.mp4'
+
+# Cut all clips of a video out of the downloaded source video
+def cut_clips(vid,src_path,cut_mode='multi',threads=1):
+  assert(cut_mode in cut_modes), \
+    "Unknown cut mode: "+str(cut_mode)
+
+  # Verify that the video has been downloaded. Skip otherwise
+  if not os.path.exists(src_path):
+    return
+
+  # Make the class directories if they don't exist yet
   for clip in vid.clips:
-    # Verify that the video has been downloaded. Skip otherwise
-    if os.path.exists(d_set_dir+'/'+vid.yt_id+'_temp.mp4'):
-      # Make the class directory if it doesn't exist yet
-      class_dir = d_set_dir+'/'+str(clip.class_id)
-      check_call(' '.join(['mkdir', '-p', class_dir]), shell=True)
-
-      # Cut out the clip within the downloaded video and save the clip
-      # in the correct class directory. Full re-encoding is used to maintain
-      # frame accuracy. See here for more detail:
-      # http://www.markbuckler.com/post/cutting-ffmpeg/
-      if debug:
-          check_call(['ffmpeg',\
-            '-i','file:'+d_set_dir+'/'+vid.yt_id+'_temp.mp4',\
-            '-ss', str(float(clip.start)/1000),\
-            '-strict','-2',\
-            '-t', str((float(clip.stop)-float(clip.start))/1000),\
-            '-threads','1',\
-            class_dir+'/'+clip.name+'.mp4'])
-      else:
-          # If not debugging, hide the error outputs from failed downloads
-          check_call(['ffmpeg',\
-            '-i','file:'+d_set_dir+'/'+vid.yt_id+'_temp.mp4',\
-            '-ss', str(float(clip.start)/1000),\
-            '-strict','-2',\
-            '-t', str((float(clip.stop)-float(clip.start))/1000),\
-            '-threads','1',\
-            class_dir+'/'+clip.name+'.mp4'],
-            stdout=FNULL,stderr=subprocess.STDOUT )
+    os.makedirs(clip.d_set_dir+'/'+str(clip.class_id), exist_ok=True)
+
+  # Cut out the clips within the downloaded video and save the clips in the
+  # correct class directories, overwriting the clips of an interrupted
+  # attempt. Unless stream copying, full re-encoding is used
+  # to maintain frame accuracy. See here for more detail:
+  # http://www.markbuckler.com/post/cutting-ffmpeg/
+  for lo in range(0,len(vid.clips),max_ffmpeg_outputs):
+    clips = vid.clips[lo:lo+max_ffmpeg_outputs]
+    if cut_mode == 'per_clip':
+      for clip in clips:
+        run_ffmpeg(['ffmpeg', '-y', '-i', 'file:'+src_path] + \
+                   _cut_args(clip,threads))
+    elif cut_mode == 'multi':
+      # One input, decoded once, with one output (and output seek) per clip
+      args = ['ffmpeg', '-y', '-i', 'file:'+src_path]
+      for clip in clips:
+        args += _cut_args(clip,threads)
+      run_ffmpeg(args)
+    elif cut_mode == 'copy':
+      # One input per clip so that each clip can seek its input to the
+      # keyframe before the clip start. Nothing is decoded.
+      args = ['ffmpeg', '-y']
+      for clip in clips:
+        args += ['-ss', str(float(clip.start)/1000),\
+                 '-t', str((float(clip.stop)-float(clip.start))/1000),\
+                 '-i', 'file:'+src_path]
+      for input_idx, clip in enumerate(clips):
+        args += ['-map', str(input_idx)+':v:0',\
+                 '-map', str(input_idx)+':a:0?',\
+                 '-c','copy',\
+                 clip_path(clip)]
+      run_ffmpeg(args)
+
+# The ffmpeg output arguments for re-encoding a clip from its source video
+def _cut_args(clip,threads):
+  return ['-ss', str(float(clip.start)/1000),\
+          '-strict','-2',\
+          '-t', str((float(clip.stop)-float(clip.start))/1000),\
+          '-threads',str(threads),\
+          clip_path(clip)]
+
+# Download a video and cut all of its clips. `fetch` is called with the video
+# to get the path of its source video. It defaults to downloading it from
+# YouTube, and can be a source_cache.
+def dl_and_cut(vid,cut_mode='multi',threads=1,fetch=download_video):
+
+  src_path = fetch(vid)
+  cut_clips(vid,src_path,cut_mode,threads)
 
   # Remove the temporary video
-  os.remove(d_set_dir+'/'+vid.yt_id+'_temp.mp4')
+  os.remove(src_path)
 
 
-# Parse the annotation csv file and schedule downloads and cuts
-def parse_annotations(d_set,dl_dir):
+# Find the annotation file of a data set. An uncompressed [D_SET].csv or a
+# compressed [D_SET].csv.gz in `annot_dir` (by default the working directory)
+# is used if there is one, otherwise the compressed file is read from
+# `source`. Returns the path or URL of the file and a description of its
+# version, which invalidates the cached store whenever the file changes.
+def annotation_file(d_set,source=None,annot_dir=None):
+  if source is None:
+    source = annot_source
+  local = [os.path.join(annot_dir or '',d_set+ext) \
+           for ext in ['.csv','.csv.gz']]
+  for path in local:
+    if os.path.exists(path):
+      break
+  else:
+    if '://' in source:
+      # Remote files are assumed not to change
+      path = source.rstrip('/')+'/'+d_set+'.csv.gz'
+      return path, [path]
+    path = os.path.join(source,d_set+'.csv.gz')
+  stat = os.stat(path)
+  if path == local[0]:
+    return path, [stat.st_size, int(stat.st_mtime)]
+  return path, [os.path.abspath(path), stat.st_size, int(stat.st_mtime)]
 
+# Open an annotation file as text, from a local path or a URL. Compressed
+# files are decompressed as they are read, without writing a copy to disk.
+def open_annotations(path,timeout=60):
+  import gzip
+  if '://' in path:
+    # Imported here as urllib.request is slow to import, and most runs read
+    # the cached columnar annotations instead
+    import urllib.request
+    f = urllib.request.urlopen(path,timeout=timeout)
+  else:
+    f = open(path,'rb')
+  if path.endswith('.gz'):
+    f = gzip.GzipFile(fileobj=f,mode='rb')
+  return io.TextIOWrapper(f,encoding='utf-8',newline='')
+
+# Load the annotation store of a data set, building and caching it as a
+# sidecar in `annot_dir` (by default the working directory) if it doesn't
+# exist yet. The annotations are streamed from `source` (see annotation_file)
+# and parsed in chunks.
+def load_annotations(d_set,source=None,annot_dir=None):
+  path, version = annotation_file(d_set,source,annot_dir)
+  store_path = os.path.join(annot_dir or '',d_set+'.cols')
+  store = annot_store.load(store_path,version)
+  if store is None:
+    print (d_set+': Parsing and sorting annotations from '+path+'...')
+    with open_annotations(path) as f:
+      store = annot_store.from_csv(d_set,f)
+    store.source = version
+    store.save(store_path)
+  return store
+
+# Parse the annotation csv file and schedule downloads and cuts. The
+# annotations are loaded from `annot_dir` as by load_annotations.
+def parse_annotations(d_set,dl_dir,annot_dir=None):
+  import numpy as np
   d_set_dir = dl_dir+'/'+d_set+'/'
 
-  # Download & extract the annotation list
-  if not os.path.exists(d_set+'.csv'):
-    print (d_set+': Downloading annotations...')
-    check_call(' '.join(['wget', web_host+d_set+'.csv.gz']),shell=True)
-    print (d_set+': Unzipping annotations...')
-    check_call(' '.join(['gzip', '-d', '-f', d_set+'.csv.gz']), shell=True)
+  annotations = load_annotations(d_set,annot_dir=annot_dir)
 
   print (d_set+': Parsing annotations into clip data...')
 
-  # Parse csv data.
-  annotations = []
-  with open((d_set+'.csv'), 'rt') as f:
-    reader = csv.reader(f)
-    annotations = list(reader)
-
-  # Sort to de-interleave the annotations for easier parsing. We use
-  # `int(l[1])` to sort by the timestamps numerically; the other fields are
-  # sorted lexicographically as strings.
-  print(d_set + ': Sorting annotations...')
-  if ('classification' in d_set):
-    class_or_det = 'class'
-    # Sort by youtube_id, class, and then timestamp
-    annotations.sort(key=lambda l: (l[0], l[2], int(l[1])))
-  elif ('detection' in d_set):
-    class_or_det = 'det'
-    # Sort by youtube_id, class, obj_id and then timestamp
-    annotations.sort(key=lambda l: (l[0], l[2], l[4], int(l[1])))
-
-  current_clip_name = ['blank']
-  clips             = []
+  # Find the rows at which a new clip starts. Rows are sorted by youtube id,
+  # class and object id so every clip is a contiguous run of rows.
+  yt  = annotations.yt
+  cls = annotations.cls
+  obj = annotations.obj
+  new_clip = np.ones(len(annotations),dtype=bool)
+  new_clip[1:] = (yt[1:] != yt[:-1]) | \
+                 (cls[1:] != cls[:-1]) | \
+                 (obj[1:] != obj[:-1])
+  clip_lo = np.flatnonzero(new_clip)
+  clip_hi = np.append(clip_lo[1:],len(annotations))
+  bounds  = np.stack((clip_lo,clip_hi),axis=1)
 
   # Parse annotations into list of clips with names, youtube ids, start
   # times and stop times
-  for idx, annotation in enumerate(annotations):
-    # If this is for a classify dataset there is no object id
-    if (class_or_det == 'class'):
-      obj_id = '0'
-    elif (class_or_det == 'det'):
-      obj_id = annotation[4]
-    yt_id    = annotation[0]
-    class_id = annotation[2]
-
-    clip_name = yt_id+'+'+class_id+'+'+obj_id
-
-    # If this is a new clip
-    if clip_name != current_clip_name:
-
-      # Update the finishing clip
-      if idx != 0: # If this isnt the first clip
-        clips[-1].stop = annotations[idx-1][1]
-
-      # Add the starting clip
-      clip_start = annotation[1]
-      clips.append( video_clip( \
-        clip_name, \
-        yt_id, \
-        clip_start, \
-        '0', \
-        class_id, \
-        obj_id, \
-        d_set_dir) )
-
-      # Update the current clip name
-      current_clip_name = clip_name
-
-  # Update the final clip with its stop time
-  clips[-1].stop = annotations[-1][1]
-
-  # Sort the clips by youtube id
-  clips.sort(key=lambda x: x.yt_id)
+  yt_cats  = annotations.yt_cats.tolist()
+  cls_cats = annotations.cls_cats.tolist()
+  obj_cats = annotations.obj_cats.tolist()
+  clips    = []
+  for yt_code, cls_code, obj_code, clip_start, clip_stop in zip( \
+      yt[clip_lo].tolist(), \
+      cls[clip_lo].tolist(), \
+      obj[clip_lo].tolist(), \
+      annotations.timestamp[clip_lo].tolist(), \
+      annotations.timestamp[clip_hi-1].tolist()):
+    yt_id    = yt_cats[yt_code]
+    class_id = cls_cats[cls_code]
+    obj_id   = obj_cats[obj_code]
+    clips.append( video_clip( \
+      yt_id+'+'+class_id+'+'+obj_id, \
+      yt_id, \
+      str(clip_start), \
+      str(clip_stop), \
+      class_id, \
+      obj_id, \
+      d_set_dir) )
+
+  # Index the clips by name for constant time lookups
+  clip_idx = clip_index(annotations,clips,bounds)
 
   # Create list of videos to download (possibility of multiple clips
-  # from one video)
-  current_vid_id = ['blank']
+  # from one video). Clips are already sorted by youtube id.
+  clip_yt = yt[clip_lo]
+  new_vid = np.ones(len(clips),dtype=bool)
+  new_vid[1:] = (clip_yt[1:] != clip_yt[:-1])
+  vid_lo = np.flatnonzero(new_vid)
+  vid_hi = np.append(vid_lo[1:],len(clips))
   vids = []
-  for clip in clips:
+  for lo, hi in zip(vid_lo.tolist(), vid_hi.tolist()):
+    vids.append( video ( \
+      clips[lo].yt_id, \
+      clips[lo] ) )
+    vids[-1].clips.extend(clips[lo+1:hi])
+
+  return annotations,clips,vids,clip_idx
+
+# Whether each clip exists, only looking for the clips `clip_ids` if given.
+# The other clips are taken to be missing.
+def clips_exist(clips,clip_ids=None):
+  import numpy as np
+  if clip_ids is None:
+    clip_ids = range(len(clips))
+  exists = np.zeros(len(clips),dtype=bool)
+  for clip_id in clip_ids:
+    exists[clip_id] = os.path.exists(clip_path(clips[clip_id]))
+  return exists
 
-    vid_id = clip.yt_id
+# Mask of the annotation rows whose frames can be decoded: the clip has been
+# downloaded (unless not `check_exists`), the object is present (unless
+# including absent frames), and the row is not the first or last frame of
+# its clip
+def frame_mask(annotations,clips,clip_idx,include_absent,check_exists=True):
+  import numpy as np
+  # If video exists
+  if check_exists:
+    keep = clips_exist(clips)[clip_idx.row_clips()]
+  else:
+    keep = np.ones(len(annotations),dtype=bool)
+  # If we are including all frames, or if the labeled object is present
+  if not include_absent:
+    keep &= annotations.present
+  # If this is not the first or last frame
+  keep &= ~clip_idx.boundary_rows()
+  return keep
 
-    # If this is a new video
-    if vid_id != current_vid_id:
-      # Add the new video with its first clip
-      vids.append( video ( \
-        clip.yt_id, \
-        clip ) )
-    # If this is a new clip for the same video
+# The ways frames can be sampled when only some of them are decoded:
+#   'random'     - A uniformly random sample of all frames
+#   'stratified' - A random sample from each class, in proportion to the
+#                  number of frames of that class
+#   'balanced'   - A random sample of the same number of frames from each
+#                  class, or all frames of the classes with fewer
+sampling_modes = ['random','stratified','balanced']
+
+# Returns a function giving a pseudo random 64 bit hash of each row of an
+# array of rows, from the row's youtube id, timestamp, class and object id and
+# `seed`. The hash of a row doesn't depend on the other rows, so samples are
+# reproducible across runs and machines.
+def row_hasher(annotations,seed=0):
+  import numpy as np
+  yt_hash = np.array([zlib.crc32(yt_id.encode('utf-8')) \
+                      for yt_id in annotations.yt_cats.tolist()],
+                     dtype=np.uint64)
+  cls_ids = np.array([int(c) for c in annotations.cls_cats.tolist()],
+                     dtype=np.uint64)
+  obj_ids = np.array([int(o) for o in annotations.obj_cats.tolist()],
+                     dtype=np.uint64)
+  seed    = np.uint64(zlib.crc32(str(seed).encode('utf-8')))
+  def hashes(rows):
+    x = (yt_hash[annotations.yt[rows]] << np.uint64(32)) ^ \
+        annotations.timestamp[rows].astype(np.uint64) ^ \
+        (cls_ids[annotations.cls[rows]] << np.uint64(48)) ^ \
+        (obj_ids[annotations.obj[rows]] << np.uint64(56)) ^ seed
+    # splitmix64 finalizer
+    x = x+np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30)))*np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27)))*np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+  return hashes
+
+# Number of frames to sample from each class, given the number of frames of
+# each class, `counts`
+def class_quotas(counts,num,mode):
+  import numpy as np
+  counts = np.asarray(counts,dtype=np.int64)
+  assert(counts.sum() >= num), \
+    "Number of frames requested exceeds number of present frames"
+  if mode == 'stratified':
+    # Largest remainder apportionment
+    exact  = counts*float(num)/max(counts.sum(),1)
+    quotas = np.floor(exact).astype(np.int64)
+    order  = np.argsort(-(exact-quotas),kind='stable')
+    quotas[order[:num-quotas.sum()]] += 1
+    return quotas
+  # Balanced: give every class an equal share, and hand the shares that the
+  # smaller classes can't fill to the larger ones
+  quotas = np.zeros(len(counts),dtype=np.int64)
+  left   = num
+  while left > 0:
+    open_  = np.flatnonzero(quotas < counts)
+    share  = max(left//len(open_),1)
+    for c in open_.tolist():
+      take = min(share,counts[c]-quotas[c],left)
+      quotas[c] += take
+      left      -= take
+  return quotas
+
+# Sample `num` of the rows in `keep` in one pass over the rows, `chunk_size`
+# rows at a time, keeping only the selected rows in between. Within each
+# stratum (each class, unless sampling randomly) the rows with the smallest
+# hashes are selected, which is a uniformly random sample that only depends
+# on `seed`. `quotas` optionally maps class ids to the number of frames to
+# sample from each class, instead of `num` and `mode`. Returns the selected
+# rows in a random but reproducible order. All rows are returned, in that
+# order, if `num` is 0.
+def sample_rows(annotations,keep,num,mode='random',seed=0,quotas=None,
+                chunk_size=1<<20):
+  import numpy as np
+  assert(mode in sampling_modes), \
+    "Unknown sampling mode: "+str(mode)
+  if (num == 0) and (quotas is None):
+    mode = 'random'
+    num  = int(np.count_nonzero(keep))
+
+  # The stratum of every row and the number of rows to sample from each
+  if (mode == 'random') and (quotas is None):
+    strata = None
+    limit  = np.array([num],dtype=np.int64)
+  else:
+    strata = annotations.cls
+    if quotas is None:
+      counts = np.bincount(annotations.cls[keep],
+                           minlength=len(annotations.cls_cats))
+      limit  = class_quotas(counts,num,mode)
     else:
-      # Add the new clip to the video
-      vids[-1].clips.append(clip)
+      limit  = np.array([quotas.get(c,0) \
+                         for c in annotations.cls_cats.tolist()],
+                        dtype=np.int64)
 
-    # Update the current video name
-    current_vid_id = vid_id
+  hashes   = row_hasher(annotations,seed)
+  sel_rows = np.zeros(0,dtype=np.int64)
+  sel_hash = np.zeros(0,dtype=np.uint64)
+  for lo in range(0,len(keep),chunk_size):
+    rows = np.flatnonzero(keep[lo:lo+chunk_size])+lo
+    if len(rows) == 0:
+      continue
+    hash_ = np.concatenate((sel_hash,hashes(rows)))
+    rows  = np.concatenate((sel_rows,rows))
+    stratum = np.zeros(len(rows),dtype=np.int64) if strata is None else \
+              strata[rows].astype(np.int64)
+    # Rank every row within its stratum by hash, and keep the rows ranked
+    # below the stratum's limit
+    order  = np.lexsort((hash_,stratum))
+    sorted_strata = stratum[order]
+    rank   = np.arange(len(order))- \
+             np.searchsorted(sorted_strata,sorted_strata,side='left')
+    chosen = order[rank < limit[sorted_strata]]
+    sel_rows, sel_hash = rows[chosen], hash_[chosen]
 
-  return annotations,clips,vids
+  assert((quotas is not None) or (len(sel_rows) == num)), \
+    "Number of frames requested exceeds number of present frames"
+  return sel_rows[np.argsort(sel_hash,kind='stable')]
 
-def sched_downloads(d_set,dl_dir,num_threads,vids):
-  d_set_dir = dl_dir+'/'+d_set+'/'
+# Sample the rows to decode as sample_rows does, dropping the clips whose
+# aspect ratio exceeds `max_ratio`. Only the clips of sampled rows are probed:
+# when a sampled clip is dropped, rows of other clips are sampled in its place.
+# With a `shard_count` greater than one only the rows of node shard
+# `shard_index` are returned. `keep` must then not depend on which clips
+# exist (see frame_mask), so that every node takes the same sample of the
+# whole data set. Each node samples as many rows (of each class, unless
+# sampling randomly) from its own clips which exist as that sample has in its
+# shard, so the node shards together select as many frames as a single
+# machine would, and the same frames when every clip exists and none is
+# dropped. A node shard which has too few frames left selects fewer.
+def select_frames(annotations,clips,clip_idx,keep,num,probes,max_ratio,
+                  num_threads=4,mode='random',seed=0,quotas=None,
+                  shard_index=0,shard_count=1):
+  import numpy as np
+  row_clips = clip_idx.row_clips()
+  keep      = keep.copy()
+  if shard_count > 1:
+    in_shard = node_shard_mask(annotations,shard_index,shard_count)
+    if (num > 0) or (quotas is not None):
+      # Sample the whole data set, without probing, and sample as many rows
+      # from the node shard as that sample has there, of each class unless
+      # sampling randomly
+      rows   = sample_rows(annotations,keep,num,mode,seed,quotas)
+      counts = np.bincount(annotations.cls[rows[in_shard[rows]]],
+                           minlength=len(annotations.cls_cats))
+      num    = int(counts.sum())
+      if num == 0:
+        return np.zeros(0,dtype=np.int64)
+      if (mode != 'random') or (quotas is not None):
+        quotas = dict(zip(annotations.cls_cats.tolist(),counts.tolist()))
+    # Only the node's own clips are on this machine
+    own  = np.unique(row_clips[in_shard])
+    keep &= in_shard & clips_exist(clips,own.tolist())[row_clips]
+  while True:
+    if (shard_count > 1) and (quotas is None):
+      # A node shard may have fewer frames left than its part of the sample
+      num = min(num,int(np.count_nonzero(keep)))
+    rows     = sample_rows(annotations,keep,num,mode,seed,quotas)
+    selected = np.zeros(len(keep),dtype=bool)
+    selected[rows] = True
+    accepted = filter_aspect(selected,clips,clip_idx,probes,max_ratio,
+                             num_threads)
+    dropped  = np.unique(row_clips[selected & ~accepted])
+    if len(dropped) == 0:
+      return rows
+    keep &= ~np.isin(row_clips,dropped)
+
+# Node shard of a video. The data sets can be split across `shard_count`
+# machines without any coordination: each video, and so every clip and frame
+# of it, belongs to exactly one shard given by a stable hash of its youtube
+# id. Downloads and decodes with the same shard count line up.
+def node_shard(yt_id,shard_count):
+  return zlib.crc32(yt_id.encode('utf-8')) % shard_count
+
+# Name of a node shard, used to keep the outputs of each shard apart
+def node_shard_name(shard_index,shard_count):
+  return 'node-{:05d}-of-{:05d}'.format(shard_index,shard_count)
+
+# The videos which belong to a node shard
+def node_shard_vids(vids,shard_index,shard_count):
+  return [vid for vid in vids \
+          if node_shard(vid.yt_id,shard_count) == shard_index]
+
+# Mask of the annotation rows which belong to a node shard
+def node_shard_mask(annotations,shard_index,shard_count):
+  import numpy as np
+  shards = np.array([node_shard(yt_id,shard_count) \
+                     for yt_id in annotations.yt_cats.tolist()],
+                    dtype=np.int64)
+  return shards[annotations.yt] == shard_index
+
+# Iterate over the annotated frames of a data set without writing anything to
+# disk. Yields a (frame, box, class_id, metadata) tuple for every frame, where
+# `frame` is a height x width x 3 RGB uint8 array of its own, `box` is the
+# [xmin, xmax, ymin, ymax] bounding box as fractions of the frame size (None
+# for classification data sets), `class_id` is an int and `metadata` is a
+# dict describing the annotation. Clips are decoded straight into memory by
+# `num_threads` worker threads, and at most `prefetch` decoded frames are
+# buffered ahead of the consumer. Frames are resized by ffmpeg if `size` is
+# given as (width, height). Clips whose aspect ratio exceeds `max_ratio` are
+# skipped. Frames of a clip are yielded together, but clips arrive in the
+# order they finish decoding.
+def iter_frames(d_set,
+                src_dir,
+                num_threads=4,
+                prefetch=256,
+                size=None,
+                include_absent=False,
+                shuffle_clips=False,
+                seed=None,
+                max_ratio=0):
+  import numpy as np
+  annotations,clips,vids,clip_idx = parse_annotations(d_set,src_dir)
+  keep   = frame_mask(annotations,clips,clip_idx,include_absent)
+  probes = load_probes(src_dir,d_set)
+  keep   = filter_aspect(keep,clips,clip_idx,probes,max_ratio,num_threads)
+
+  # The rows to decode from each clip
+  tasks = []
+  for clip_id, (lo, hi) in enumerate(clip_idx.bounds.tolist()):
+    rows = np.flatnonzero(keep[lo:hi])
+    if len(rows):
+      tasks.append((clip_id, rows+lo))
+  if shuffle_clips:
+    random.Random(seed).shuffle(tasks)
+
+  frame_queue = queue.Queue(maxsize=prefetch)
+  stop        = threading.Event()
+  done        = object()
+
+  def put(item):
+    # Wait for room in the buffer unless the consumer has gone away
+    while not stop.is_set():
+      try:
+        frame_queue.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def decode(clip_id,rows):
+    clip = clips[clip_id]
+    try:
+      times  = annotations.timestamp[rows]
+      frames = decode_clip_raw(clip_path(clip),
+                               times-int(clip.start),
+                               size,
+                               probes)
+    except Exception as exc:
+      print('decode failed', clip.name, exc)
+      return
+    for row, frame in zip(rows.tolist(), frames):
+      if frame is None:
+        continue
+      annot = annotations[row]
+      box   = None
+      if annotations.class_or_det == 'det':
+        box = np.array(annotations.boxes[row], dtype=np.float32)
+      metadata = {'d_set':      d_set,
+                  'clip_name':  clip.name,
+                  'yt_id':      annot[0],
+                  'timestamp':  int(annot[1]),
+                  'class_name': annot[3],
+                  'obj_id':     clip.obj_id,
+                  'present':    bool(annotations.present[row])}
+      if not put((frame, box, int(annot[2]), metadata)):
+        return
+
+  def produce():
+    # Keep enough clips in flight to occupy every worker, but no more
+    window = threading.Semaphore(2*num_threads)
+    try:
+      with futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for clip_id, rows in tasks:
+          window.acquire()
+          if stop.is_set():
+            window.release()
+            break
+          f = executor.submit(decode,clip_id,rows)
+          f.add_done_callback(lambda f: window.release())
+    finally:
+      put(done)
+
+  producer = threading.Thread(target=produce)
+  producer.daemon = True
+  producer.start()
+  try:
+    while True:
+      item = frame_queue.get()
+      if item is done:
+        break
+      yield item
+  finally:
+    # Stop the workers if the consumer stopped early
+    stop.set()
+    producer.join()
+    probes.save()
+
+# Name of the data set that a clip belongs to
+def clip_d_set(clip):
+  return os.path.basename(os.path.normpath(clip.d_set_dir))
+
+# Persistent journal of download progress, stored in a SQLite database. It
+# records the state of every video and clip of each data set, so that a
+# restarted run can skip finished work with one query per data set rather
+# than checking for hundreds of thousands of clip files. Videos and clips
+# move through these states:
+#   pending     - Not yet downloaded, or downloading
+#   downloaded  - Downloaded, waiting to be cut or being cut
+#   cut         - All clips cut. Finished.
+#   failed      - Download or cut failed. `reason` says why.
+#   unavailable - The video is gone from YouTube
+class dl_journal(object):
+  def __init__(self,path,max_attempts=3,retry_unavailable=False):
+    import sqlite3
+    self.max_attempts      = max_attempts
+    self.retry_unavailable = retry_unavailable
+    self.lock = threading.Lock()
+    self.db   = sqlite3.connect(path,check_same_thread=False)
+    self.db.execute('PRAGMA journal_mode=WAL')
+    self.db.execute('PRAGMA synchronous=NORMAL')
+    self.db.execute('CREATE TABLE IF NOT EXISTS videos ('
+                    'd_set TEXT, yt_id TEXT, state TEXT, reason TEXT, '
+                    'attempts INTEGER DEFAULT 0, updated REAL, '
+                    'PRIMARY KEY (d_set, yt_id))')
+    self.db.execute('CREATE TABLE IF NOT EXISTS clips ('
+                    'd_set TEXT, name TEXT, yt_id TEXT, state TEXT, '
+                    'PRIMARY KEY (d_set, name))')
+    self.db.commit()
+
+  def states(self,d_set):
+    # Map of youtube id to (state, attempts) for every video of a data set
+    with self.lock:
+      rows = self.db.execute('SELECT yt_id, state, attempts FROM videos '
+                             'WHERE d_set = ?', (d_set,)).fetchall()
+    return dict((yt_id, (state, attempts)) for yt_id, state, attempts in rows)
+
+  def filter(self,d_set,vids):
+    # Return the videos of a data set which still need to be processed,
+    # recording any new videos and clips as pending
+    states = self.states(d_set)
+    todo   = []
+    for vid in vids:
+      state, attempts = states.get(vid.yt_id, ('pending', 0))
+      if state == 'cut':
+        continue
+      if (state == 'unavailable') and not self.retry_unavailable:
+        continue
+      if (state == 'failed') and (attempts >= self.max_attempts):
+        continue
+      todo.append(vid)
+    with self.lock:
+      self.db.executemany('INSERT OR IGNORE INTO videos (d_set, yt_id, state) '
+                          'VALUES (?, ?, ?)',
+                          ((d_set, vid.yt_id, 'pending') for vid in todo))
+      self.db.executemany('INSERT OR IGNORE INTO clips '
+                          '(d_set, name, yt_id, state) VALUES (?, ?, ?, ?)',
+                          ((d_set, clip.name, vid.yt_id, 'pending') \
+                           for vid in todo for clip in vid.clips))
+      self.db.commit()
+    return todo
+
+  def update(self,vid,state,reason=None):
+    # Record the new state of a video and of all of its clips
+    now = time.time()
+    with self.lock:
+      for d_set in set(clip_d_set(clip) for clip in vid.clips):
+        if state == 'pending':
+          # A new attempt at downloading the video
+          self.db.execute('UPDATE videos SET state = ?, reason = NULL, '
+                          'attempts = attempts + 1, updated = ? '
+                          'WHERE d_set = ? AND yt_id = ?',
+                          (state, now, d_set, vid.yt_id))
+        else:
+          self.db.execute('UPDATE videos SET state = ?, reason = ?, '
+                          'updated = ? WHERE d_set = ? AND yt_id = ?',
+                          (state, reason, now, d_set, vid.yt_id))
+      self.db.executemany('UPDATE clips SET state = ? '
+                          'WHERE d_set = ? AND name = ?',
+                          ((state, clip_d_set(clip), clip.name) \
+                           for clip in vid.clips))
+      self.db.commit()
+
+  def close(self):
+    with self.lock:
+      self.db.close()
+
+# Model of how long a video takes to download and cut, estimated from its
+# clips: downloading is proportional to the length of the source video (at
+# least up to the end of its last clip) and cutting to the total length of
+# its clips, plus a fixed cost per clip for starting each output. The rates
+# start from rough guesses and follow the times observed during the run,
+# smoothed by an exponential moving average.
+class cost_model(object):
+  def __init__(self,
+               dl_rate=0.1,
+               cut_rate=1.0,
+               clip_overhead=1.0,
+               smoothing=0.1):
+    self.dl_rate       = dl_rate        # Seconds per second of source video
+    self.cut_rate      = cut_rate       # Seconds per second of clip
+    self.clip_overhead = clip_overhead  # Seconds of clip each clip costs extra
+    self.smoothing     = smoothing
+    self.observed      = 0
+    self.lock          = threading.Lock()
+
+  def features(self,vid):
+    # Seconds of source video to download, and seconds of clips to cut
+    video_secs = max(float(clip.stop) for clip in vid.clips)/1000.0
+    clip_secs  = sum(float(clip.stop)-float(clip.start) \
+                     for clip in vid.clips)/1000.0
+    return video_secs, clip_secs+self.clip_overhead*len(vid.clips)
+
+  def estimate(self,vid):
+    video_secs, cut_secs = self.features(vid)
+    return self.dl_rate*video_secs+self.cut_rate*cut_secs
+
+  def _update(self,rate,seconds,work):
+    # Move the rate towards the rate observed for this video
+    if work <= 0:
+      return rate
+    return (1-self.smoothing)*rate+self.smoothing*(seconds/work)
+
+  def observe_download(self,vid,seconds):
+    with self.lock:
+      self.dl_rate   = self._update(self.dl_rate,seconds,self.features(vid)[0])
+      self.observed += 1
+    stats.set('cost_rate',self.dl_rate,stage='download')
+
+  def observe_cut(self,vid,seconds):
+    with self.lock:
+      self.cut_rate  = self._update(self.cut_rate,seconds,self.features(vid)[1])
+      self.observed += 1
+    stats.set('cost_rate',self.cut_rate,stage='cut')
+
+# Videos waiting to be started, which pop() returns most expensive first
+# according to `costs`, or in order of youtube id without a cost model. The
+# features of each video are computed once, when it's added. An estimate is a
+# weighted sum of the features, so the order only depends on the ratio of the
+# download and cut rates. The videos are reordered when videos were added, and
+# when that ratio has moved by more than `tolerance` since the last ordering
+# and the number of observations of the cost model has at least doubled
+# (starting from `refresh`), so that a run only reorders a few dozen times.
+class cost_order(object):
+  def __init__(self,costs=None,tolerance=0.1,refresh=32):
+    self.costs     = costs
+    self.tolerance = tolerance
+    self.refresh   = refresh
+    self.vids      = {}    # Waiting videos, by youtube id
+    self.features  = {}    # Features of the waiting videos, by youtube id
+    self.order     = []    # Youtube ids, the next video last
+    self.ratio     = None  # Rate ratio of the order, None to reorder
+    self.sorted_at = 0     # Observations of the cost model at the ordering
+
+  def __len__(self):
+    return len(self.vids)
+
+  def __contains__(self,yt_id):
+    return yt_id in self.vids
+
+  def get(self,yt_id):
+    return self.vids[yt_id]
+
+  def add(self,vid):
+    # Add a video, or update a waiting video whose clips have changed
+    self.vids[vid.yt_id] = vid
+    if self.costs is not None:
+      self.features[vid.yt_id] = self.costs.features(vid)
+    self.ratio = None
+
+  def pop(self):
+    if self.costs is None:
+      if self.ratio is None:
+        self.order = sorted(self.vids,reverse=True)
+        self.ratio = 0
+    else:
+      ratio    = self.costs.dl_rate/max(self.costs.cut_rate,1e-9)
+      observed = self.costs.observed
+      if (self.ratio is None) or \
+         ((observed >= max(2*self.sorted_at,self.refresh)) and \
+          (abs(ratio-self.ratio) > self.tolerance*self.ratio)):
+        self._sort(ratio)
+        self.sorted_at = observed
+    yt_id = self.order.pop()
+    self.features.pop(yt_id,None)
+    return self.vids.pop(yt_id)
 
-  # Make the directory for this dataset
-  check_call(' '.join(['mkdir', '-p', d_set_dir]), shell=True)
+  def _sort(self,ratio):
+    # Sort ascending by estimate over the cut rate, so that the most
+    # expensive video is popped first
+    import numpy as np
+    yt_ids   = list(self.vids)
+    features = np.array([self.features[yt_id] for yt_id in yt_ids],
+                        dtype=np.float64).reshape(-1,2)
+    keys     = ratio*features[:,0]+features[:,1]
+    self.order = [yt_ids[i] for i in np.argsort(keys,kind='stable').tolist()]
+    self.ratio = ratio
 
+# Yield videos most expensive first according to `costs`, so that the long
+# videos are started early rather than straggling at the end of a run while
+# most workers sit idle. The order follows the cost model as it learns.
+def longest_first(vids,costs):
+  order = cost_order(costs)
+  for vid in vids:
+    order.add(vid)
+  while len(order) > 0:
+    yield order.pop()
+
+# Two stage download and cut pipeline. Videos are downloaded by a pool of
+# download threads (network bound) and cut by a separate pool of cut threads
+# (compute bound), so that neither the network nor the CPUs sit idle while the
+# other stage works. Each video holds a slot from the moment it is submitted
+# until its clips are cut and its source video is removed, so at most
+# `max_pending` source videos are ever on disk. submit() blocks while all
+# slots are taken, which applies backpressure to the downloads whenever
+# cutting falls behind. Source videos are fetched with `fetch`, which
+# defaults to downloading them from YouTube. The download and cut times of
+# every video are fed back to the cost model `costs` if given. With an
+# autotuner `tuner` the cuts are run through it, which sets how many cuts run
+# at once and how many threads each uses.
+class dl_pipeline(object):
+  def __init__(self,
+               num_dl_threads,
+               num_cut_threads,
+               max_pending=None,
+               cut_mode='multi',
+               total=None,
+               journal=None,
+               fetch=download_video,
+               costs=None,
+               tuner=None):
+    # The autotuner decides how many of the cut threads run at once
+    if tuner is not None:
+      num_cut_threads = max(num_cut_threads,tuner.max_jobs)
+    if max_pending is None:
+      max_pending = num_dl_threads+2*num_cut_threads
+    self.cut_mode = cut_mode
+    self.total    = total
+    self.journal  = journal
+    self.fetch    = fetch
+    self.costs    = costs
+    self.tuner    = tuner
+    self.dl_pool  = futures.ThreadPoolExecutor(max_workers=num_dl_threads)
+    self.cut_pool = futures.ThreadPoolExecutor(max_workers=num_cut_threads)
+    self.slots    = threading.Semaphore(max_pending)
+    self.lock     = threading.Condition()
+    self.counts   = dict((stage, 0) for stage in \
+      ['submitted','downloaded','dl_failed','cut_queue','cut','cut_failed'])
+    # Follow ups of the videos being processed, by youtube id, and the
+    # source videos kept for follow ups while `retain` is set, oldest first.
+    # A kept source video keeps the slot of its video.
+    self.late     = {}
+    self.sources  = {}
+    self.retain   = False
+
+  def submit(self,vid):
+    # Wait for a free slot before starting the download
+    self._acquire()
+    with self.lock:
+      self.late[vid.yt_id] = []
+    self._count('submitted')
+    self.dl_pool.submit(self._download,vid)
+
+  # Take a slot, removing the oldest kept source video to free one if need
+  # be, so that kept source videos count towards `max_pending` too
+  def _acquire(self):
+    while not self.slots.acquire(blocking=False):
+      with self.lock:
+        if self.slots.acquire(blocking=False):
+          return
+        if self.sources:
+          yt_id    = next(iter(self.sources))
+          src_path = self.sources.pop(yt_id)
+          if os.path.exists(src_path):
+            os.remove(src_path)
+          self.slots.release()
+        else:
+          # Slots are freed as videos finish, which notifies the lock
+          self.lock.wait()
+
+  # Cut the clips of `vid`, a video which was already submitted with other
+  # clips, from the source video of that submission instead of downloading
+  # it again. The clips are cut once the source is downloaded, or from the
+  # kept source if it's already finished, which then takes over the kept
+  # source's slot. Returns False if there is no source to cut them from.
+  def follow_up(self,vid):
+    with self.lock:
+      if vid.yt_id in self.late:
+        self.late[vid.yt_id].append(vid)
+        stats.set_total('videos_finished_total',1)
+        return True
+      source = self.sources.pop(vid.yt_id,None)
+      if source is None:
+        return False
+      src_path = vid.clips[0].d_set_dir+'/'+vid.yt_id+'_temp.mp4'
+      try:
+        os.replace(source,src_path)
+      except OSError:
+        self.slots.release()
+        return False
+      self.late[vid.yt_id] = []
+      if self.total is not None:
+        self.total += 1
+    stats.set_total('videos_finished_total',1)
+    self._count('submitted')
+    self._count('downloaded')
+    self._count('cut_queue')
+    self.cut_pool.submit(self._cut,vid,src_path)
+    return True
+
+  # Stop keeping source videos for follow ups, and remove the kept ones
+  def release(self):
+    with self.lock:
+      self.retain  = False
+      sources      = self.sources
+      self.sources = {}
+    for src_path in sources.values():
+      if os.path.exists(src_path):
+        os.remove(src_path)
+      self.slots.release()
+
+  def _download(self,vid):
+    # Any failure, including recording the download, fails the video so that
+    # its slot is freed
+    src_path = None
+    try:
+      self._journal(vid,'pending')
+      start    = time.time()
+      src_path = self.fetch(vid)
+      elapsed  = time.time()-start
+      # Videos found in the source cache weren't downloaded, so they don't
+      # count as downloads or tell the cost model anything about them
+      if not (isinstance(self.fetch,source_cache) and self.fetch.hit()):
+        stats.observe('download_seconds',elapsed)
+        stats.inc('download_bytes_total',os.path.getsize(src_path))
+        if self.costs is not None:
+          self.costs.observe_download(vid,elapsed)
+      self._journal(vid,'downloaded')
+    except Exception as exc:
+      self._finish(vid,src_path,'dl_failed',exc)
+      return
+    self._count('downloaded')
+    self._count('cut_queue')
+    self.cut_pool.submit(self._cut,vid,src_path)
+
+  def _cut(self,vid,src_path):
+    self._count('cut_queue',-1)
+    exc = self._cut_clips(vid,src_path)
+    self._finish(vid,src_path,'cut' if exc is None else 'cut_failed',exc)
+
+  # Cut the clips of a video, returning the exception cutting failed with
+  def _cut_clips(self,vid,src_path):
+    start = time.time()
+    try:
+      if self.tuner is None:
+        cut_clips(vid,src_path,self.cut_mode)
+      else:
+        # Throughput is measured in seconds of clips cut
+        self.tuner.run(cut_clips,vid,src_path,self.cut_mode,
+                       work=sum(float(clip.stop)-float(clip.start) \
+                                for clip in vid.clips)/1000.0)
+      elapsed = time.time()-start
+      stats.observe('cut_seconds',elapsed)
+      if self.costs is not None:
+        self.costs.observe_cut(vid,elapsed)
+      stats.inc('clips_cut_total',len(vid.clips))
+    except Exception as exc:
+      return exc
+    return None
+
+  def _finish(self,vid,src_path,stage,exc):
+    # Cut the follow ups which came in while the video was processed, remove
+    # the temporary video (or keep it, with its slot, for more follow ups)
+    # and record the outcome. The slot is freed even if that fails, as
+    # join() waits for every slot's video to finish.
+    kept = False
+    try:
+      while True:
+        with self.lock:
+          late = self.late.pop(vid.yt_id,[])
+          if late:
+            self.late[vid.yt_id] = []
+          elif self.retain and (stage == 'cut') and os.path.exists(src_path):
+            self.sources[vid.yt_id] = src_path
+            src_path = None
+            kept     = True
+        if not late:
+          break
+        for late_vid in late:
+          if stage == 'dl_failed':
+            self._record(late_vid,stage,exc)
+          else:
+            late_exc = self._cut_clips(late_vid,src_path)
+            self._record(late_vid,'cut' if late_exc is None else 'cut_failed',
+                         late_exc)
+      if (src_path is not None) and os.path.exists(src_path):
+        os.remove(src_path)
+      self._record(vid,stage,exc)
+    except Exception as err:
+      print(vid.yt_id+': failed to record '+stage, err)
+    finally:
+      if not kept:
+        self.slots.release()
+      self._count(stage)
+
+  def _record(self,vid,stage,exc):
+    try:
+      if debug and (exc is not None):
+        print(vid.yt_id+': '+stage, exc)
+      if exc is None:
+        self._journal(vid,'cut')
+      elif getattr(exc,'unavailable',False):
+        self._journal(vid,'unavailable',exc.reason)
+        stats.inc('failures_total',stage='download',cause='unavailable')
+      elif stage == 'dl_failed':
+        self._journal(vid,'failed',getattr(exc,'reason',str(exc)))
+        stats.inc('failures_total',stage='download',cause=type(exc).__name__)
+      else:
+        self._journal(vid,'failed','cut: '+str(exc))
+        stats.inc('failures_total',stage='cut',cause=type(exc).__name__)
+      stats.inc('videos_finished_total',state=stage)
+    except Exception as err:
+      print(vid.yt_id+': failed to record '+stage, err)
+
+  def _journal(self,vid,state,reason=None):
+    if self.journal is not None:
+      self.journal.update(vid,state,reason)
+
+  def _count(self,stage,delta=1):
+    with self.lock:
+      self.counts[stage] += delta
+      self.lock.notify_all()
+      counts = self.counts
+      stats.set('queue_depth',counts['cut_queue'],queue='cut')
+      stats.set('queue_depth',counts['downloaded']-counts['cut_queue']- \
+                counts['cut']-counts['cut_failed'],queue='cutting')
+      stats.set('queue_depth',counts['submitted']-counts['downloaded']- \
+                counts['dl_failed'],queue='download')
+      if stage != 'submitted':
+        self._report()
+
+  def _report(self):
+    # Write progress to error so that it can be seen
+    counts = self.counts
+    total  = self.total if self.total is not None else counts['submitted']
+    sys.stderr.write( \
+      "Downloaded video: {} / {}, cut: {} / {}, waiting to cut: {}, " \
+      "failed downloads: {}, failed cuts: {} \r".format( \
+        counts['downloaded'], total,
+        counts['cut'], total,
+        counts['cut_queue'],
+        counts['dl_failed'],
+        counts['cut_failed']))
+
+  def join(self):
+    # Wait for every submitted video to be finished
+    with self.lock:
+      while (self.counts['cut']+self.counts['cut_failed']+ \
+             self.counts['dl_failed']) < self.counts['submitted']:
+        self.lock.wait()
+
+  def close(self):
+    self.join()
+    self.dl_pool.shutdown()
+    self.cut_pool.shutdown()
+
+# Merge lists of videos by youtube id, so that a video which appears in more
+# than one data set is downloaded once and all of its clips are cut from that
+# one download. Each clip keeps its own data set directory, so the clips are
+# written where they would be had the data sets been downloaded one by one.
+def merge_vids(vids_lists):
+  merged = {}
+  for vids in vids_lists:
+    for vid in vids:
+      if vid.yt_id not in merged:
+        merged[vid.yt_id] = video(vid.yt_id,vid.clips[0])
+        merged[vid.yt_id].clips.extend(vid.clips[1:])
+      else:
+        merged[vid.yt_id].clips.extend(vid.clips)
+  return [merged[yt_id] for yt_id in sorted(merged)]
+
+# Plan the downloads of the data sets `d_sets`, given the list of videos of
+# each in `vids_lists`. Returns the videos left to download, merged across the
+# data sets.
+def plan_downloads(d_sets,dl_dir,vids_lists,journal=None):
+  todo = []
+  for d_set, vids in zip(d_sets,vids_lists):
+    d_set_dir = dl_dir+'/'+d_set+'/'
+
+    # Make the directory for this dataset
+    check_call(' '.join(['mkdir', '-p', d_set_dir]), shell=True)
+
+    # Skip the videos which a previous run already finished
+    if journal is not None:
+      num_vids = len(vids)
+      vids = journal.filter(d_set,vids)
+      print(d_set+': Skipping '+str(num_vids-len(vids))+ \
+            ' videos finished or given up on by previous runs')
+    todo.append(vids)
+
+  vids = merge_vids(todo)
+  if len(d_sets) > 1:
+    print('Downloading '+str(len(vids))+' videos for '+ \
+          str(sum(len(v) for v in todo))+' videos of '+ \
+          str(len(d_sets))+' data sets')
+  return vids
+
+# Download and cut the videos `vids` of a plan. `name` names the data sets
+# being downloaded in the messages.
+def run_downloads(name,
+                  num_threads,
+                  vids,
+                  cut_mode='multi',
+                  num_dl_threads=None,
+                  max_pending=None,
+                  journal=None,
+                  costs=None,
+                  tuner=None,
+                  fetch=download_video):
   # Tell the user when downloads were started
-  datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+  print(name+': Starting downloads at '+ \
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+  stats.set_total('videos_finished_total',len(vids))
+
+  # Download and cut in separate pools of threads. Both stages run external
+  # programs, so threads are enough to keep every core busy.
+  if num_dl_threads is None:
+    num_dl_threads = num_threads
+  pipeline = dl_pipeline(num_dl_threads,
+                         num_threads,
+                         max_pending,
+                         cut_mode,
+                         total=len(vids),
+                         journal=journal,
+                         costs=costs,
+                         tuner=tuner,
+                         fetch=fetch)
+  # Start the most expensive videos first if given a cost model, otherwise
+  # go in order of youtube id
+  if costs is not None:
+    vids = longest_first(vids,costs)
+  for vid in vids:
+    pipeline.submit(vid)
+  pipeline.close()
+
+  print( name+': All videos downloaded' )
+
+# Download and cut the videos of the data sets `d_sets` with one pipeline for
+# the whole run. The data sets are parsed by `load_vids`, which returns the
+# list of videos of a data set, in a background thread, and their videos are
+# fed to the pipeline as soon as each one is parsed, so the pipeline doesn't
+# wait for the parsing of the next data set or drain between data sets. A
+# video which appears in a data set parsed while it's still waiting to be
+# started takes the clips of that data set too, as in plan_downloads. The
+# clips of a video which was already started are cut from its source video
+# as a follow up. The source videos are kept until every data set is parsed,
+# within the `max_pending` slots of the pipeline: the oldest kept source is
+# removed when a new video needs its slot. A video is only downloaded again
+# if it failed or its source video was removed.
+def stream_downloads(d_sets,
+                     dl_dir,
+                     num_threads,
+                     load_vids,
+                     cut_mode='multi',
+                     num_dl_threads=None,
+                     max_pending=None,
+                     journal=None,
+                     costs=None,
+                     tuner=None,
+                     fetch=download_video):
+  parsed = queue.Queue()
+  def parse():
+    try:
+      for d_set in d_sets:
+        parsed.put(plan_downloads([d_set],dl_dir,[load_vids(d_set)],journal))
+    except Exception as exc:
+      parsed.put(exc)
+    parsed.put(None)
+  parser = threading.Thread(target=parse)
+  parser.daemon = True
+  parser.start()
+
+  print('Starting downloads at '+datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+
+  if num_dl_threads is None:
+    num_dl_threads = num_threads
+  pipeline = dl_pipeline(num_dl_threads,
+                         num_threads,
+                         max_pending,
+                         cut_mode,
+                         total=0,
+                         journal=journal,
+                         costs=costs,
+                         tuner=tuner,
+                         fetch=fetch)
+
+  # Start the most expensive videos first if given a cost model, otherwise
+  # go in order of youtube id
+  waiting   = cost_order(costs)
+  started   = set()
+  repeated  = 0
+  error     = None
+  parsing   = True
+  pipeline.retain = True
+  try:
+    while parsing or waiting:
+      # Take the videos of every data set parsed so far, and only wait for
+      # the parser when there is nothing left to start
+      while parsing:
+        try:
+          vids = parsed.get(block=not waiting)
+        except queue.Empty:
+          break
+        if vids is None:
+          parsing = False
+          pipeline.release()
+        elif isinstance(vids,Exception):
+          error = vids
+        else:
+          new = 0
+          for vid in vids:
+            if vid.yt_id in waiting:
+              merged = waiting.get(vid.yt_id)
+              merged.clips.extend(vid.clips)
+            elif (vid.yt_id in started) and pipeline.follow_up(vid):
+              continue
+            else:
+              if vid.yt_id in started:
+                repeated += 1
+              merged = video(vid.yt_id,vid.clips[0])
+              merged.clips.extend(vid.clips[1:])
+              new += 1
+            waiting.add(merged)
+          pipeline.total += new
+          stats.set_total('videos_finished_total',new)
+      if not waiting:
+        continue
+
+      vid = waiting.pop()
+      started.add(vid.yt_id)
+      pipeline.submit(vid)
+  finally:
+    pipeline.close()
+    pipeline.release()
+
+  if repeated > 0:
+    print(str(repeated)+' videos were downloaded again for a later data '
+          'set, as they had failed or their source video had been removed '
+          'to stay within the maximum pending videos')
+  print('All videos downloaded')
+  if error is not None:
+    raise error
+
+def sched_downloads(d_set,
+                    dl_dir,
+                    num_threads,
+                    vids,
+                    cut_mode='multi',
+                    num_dl_threads=None,
+                    max_pending=None,
+                    journal=None,
+                    costs=None,
+                    tuner=None,
+                    fetch=download_video):
+  vids = plan_downloads([d_set],dl_dir,[vids],journal)
+  run_downloads(d_set,num_threads,vids,cut_mode,num_dl_threads,max_pending,
+                journal,costs,tuner,fetch)
+
+# Type of the 0 or 1 flags which the scripts used to take as positional
+# arguments
+def flag_arg(value):
+  if value not in ['0','1']:
+    raise ValueError(value)
+  return value == '1'
+
+# The standalone scripts still accept the arguments which used to be
+# positional, and are now options, in their old order after the other
+# positional arguments, so that old command lines keep working. Each of
+# `options` is the dest of an option and the type of its positional form.
+def add_positional_options(parser,options):
+  import argparse
+  for dest, type in options:
+    parser.add_argument('positional_'+dest, nargs='?', type=type,
+                        default=None, help=argparse.SUPPRESS)
+
+# Parse the command line of a standalone script, letting the positional
+# forms of `options` set the options
+def parse_positional_options(parser,options,argv=None):
+  args = parser.parse_args(argv)
+  for dest, type in options:
+    value = getattr(args,'positional_'+dest)
+    delattr(args,'positional_'+dest)
+    if value is not None:
+      setattr(args,dest,value)
+  return args
+
+# Add the options of the scripts which write metrics to `parser`
+def add_metrics_arguments(parser):
+  parser.add_argument('--metrics', default=None, metavar='PATH',
+    help='Periodically write progress and performance metrics to PATH, in '
+         'the Prometheus text format if PATH ends in .prom and as JSON lines '
+         'otherwise')
+  parser.add_argument('--metrics-interval', type=float, default=30,
+    metavar='SEC',
+    help='Seconds between metrics writes (default: %(default)s)')
+
+# Start writing the metrics if the --metrics option was given
+def start_metrics(args):
+  if args.metrics is not None:
+    stats.start(args.metrics,args.metrics_interval)
+
+# Add the options of the scripts which autotune their ffmpeg jobs to `parser`.
+# `jobs` describes the jobs, and `start` the options the tuning starts from.
+def add_autotune_arguments(parser,jobs,start='--num-threads'):
+  parser.add_argument('--autotune', action='store_true',
+    help='Tune the number of {} at once and the number of threads each '
+         'ffmpeg uses during the run, starting from {}'.format(jobs,start))
+  parser.add_argument('--max-jobs', type=int, default=None,
+    help='Most {} at once when autotuning (default: number of '
+         'CPUs)'.format(jobs))
+  parser.add_argument('--max-ffmpeg-threads', type=int, default=4,
+    help='Most threads per ffmpeg when autotuning (default: %(default)s)')
+
+# Start an autotuner if the --autotune option was given, starting from
+# `args.num_threads` jobs with `ffmpeg_threads` threads each. Returns None
+# otherwise.
+def make_tuner(args,ffmpeg_threads=1):
+  if not args.autotune:
+    return None
+  tuner = autotuner(args.num_threads,
+                    args.max_jobs or os.cpu_count() or args.num_threads,
+                    ffmpeg_threads,
+                    args.max_ffmpeg_threads)
+  tuner.start()
+  return tuner
 
-  # Download and cut in parallel threads giving
-  with futures.ProcessPoolExecutor(max_workers=num_threads) as executor:
-    fs = [executor.submit(dl_and_cut,vid) for vid in vids]
-    for i, f in enumerate(futures.as_completed(fs)):
-      # Write progress to error so that it can be seen
-      sys.stderr.write( \
-        "Downloaded video: {} / {} \r".format(i, len(vids)))
+# Subcommands of the youtube_bb command: the script implementing each one,
+# what it does and the options of the script's add_arguments
+commands = [
+  ['download', 'download',     'Download and cut the videos', {}],
+  ['cut',      'download',     'Cut the clips from local source videos',
+               {'cut': True}],
+  ['decode',   'decode',       'Decode the clips into 30 fps frames', {}],
+  ['voc',      'voc_convert',  'Convert the detection data sets into the '
+                               'VOC 2007 format', {}],
+  ['classify', 'class_decode', 'Decode the labeled frames of the '
+                               'classification data sets', {}],
+  ['merge',    'voc_merge',    'Merge the ImageSets files of a VOC 2007 '
+                               'conversion split across node shards', {}],
+  ]
 
-  print( d_set+': All videos downloaded' )
+# Run the youtube_bb command. Only the script of the subcommand being run is
+# imported, so that short commands start quickly.
+def cli(argv=None):
+  import argparse
+  import importlib
+  if argv is None:
+    argv = sys.argv[1:]
+  parser = argparse.ArgumentParser(prog='youtube_bb',
+    description='Download, cut, decode and convert the YouTube '
+                'BoundingBoxes data set.')
+  subparsers = parser.add_subparsers(dest='command', metavar='COMMAND')
+  subparsers.required = True
+  command = next((arg for arg in argv if not arg.startswith('-')), None)
+  script  = None
+  for name, module, help, options in commands:
+    subparser = subparsers.add_parser(name, help=help, description=help)
+    if name == command:
+      script = importlib.import_module(module)
+      script.add_arguments(subparser, **options)
+  args = parser.parse_args(argv)
+  script.main(args)
 
+if __name__ == '__main__':
+  # Run the command with the imported module rather than with __main__, so
+  # that the scripts and the command share the module's state
+  import youtube_bb
+  youtube_bb.cli()